@@ -21,9 +21,12 @@ AUTHOR
        Written by Axel Wellpott (axll[at]faam[dot]ac[dot]uk)
 """
 
+import multiprocessing
 import numpy as np
 import sys
 
+from faam_wxrx.profiling import hot_path
+
 try:
     import bitstring
 except ImportError:
@@ -36,6 +39,11 @@ except ImportError:
 
 _LABEL = '550'
 
+# version of the output of Arinc708.parse_many; has to be increased whenever
+# the decoding changes, so that records from the cache (see cache.py) are not
+# used anymore
+DECODER_VERSION = 1
+
 _REC = np.zeros(1, dtype=[('label',             np.str_, 4),
                           ('control_accept',    np.byte),
                           ('slave',             np.byte),
@@ -52,6 +60,154 @@ _REC = np.zeros(1, dtype=[('label',             np.str_, 4),
 
 _REC.dtype.fields.keys()
 
+# the header fields of _REC without the reflectivity (see
+# Arinc708.parse_headers)
+_HEADER = np.zeros(1, dtype=[(name, _REC.dtype[name]) for name in _REC.dtype.names
+                             if name != 'reflectivity'])
+
+# number of records that are decoded in one go by Arinc708.parse_many; keeps
+# the temporary arrays at around 15MB
+_BLOCK_SIZE = 8192
+# the same for Arinc708.parse_headers
+_HEADER_BLOCK_SIZE = 2**16
+
+# octal string representation of all possible 9 bit labels
+_OCTAL = np.array(['%03o' % i for i in range(512)])
+
+# lookup table for the range code (see Arinc708.__get_range_data__)
+_RANGE_CODE = np.zeros(64, dtype=np.int16) + 9999
+for _code, _nm in ((1, 5), (2, 10), (4, 20), (8, 40), (16, 80), (32, 160), (63, 315), (0, 320)):
+    _RANGE_CODE[_code] = _nm
+
+# bit patterns read as decimal number, e.g. 0b101 -> 101 (see
+# Arinc708.__get_faults__)
+_DECIMAL = np.array([int('{0:b}'.format(i)) for i in range(128)], dtype=np.int64)
+# The mode annunciation and the faults are stored as the decimal number of
+# their bits in a byte, which wraps around for most bit patterns. The
+# wrapped values are still unique, so the bits can be looked up.
+_DECIMAL_BITS = np.zeros(256, dtype=np.int64)
+_DECIMAL_BITS[_DECIMAL.astype(np.int8).view(np.uint8)] = np.arange(len(_DECIMAL))
+
+# position of the eight 3 bit gates in every 24 bit word of the data section
+_GATE_SHIFT = np.arange(0, 24, 3, dtype=np.uint32)
+
+
+def unwrap_bits(values):
+    """Returns the bit patterns (e.g. 5 for the bits 101) of stored
+    mode_annunciation or faults values.
+
+    """
+    return _DECIMAL_BITS[np.asarray(values, dtype=np.int8).view(np.uint8)]
+
+
+def _get_rows_(buffer, offsets, nbytes=200):
+    """Returns the 200 bytes (or the first *nbytes*) of the buswords
+    starting at the bit *offsets* of the byte *buffer*, as they are stored
+    in the file.
+
+    In clean stretches of the data all buswords start at a byte boundary
+    and 218 bytes (1744 bits) apart from each other. The buswords are then
+    returned as a strided view of the buffer without copying anything.
+    Otherwise they are gathered and shifted to the byte boundary.
+
+    """
+    byte_ix = offsets // 8
+    shift = offsets % 8
+    if len(offsets) > 1 and not shift.any() and np.all(np.diff(byte_ix) == 218):
+        return np.lib.stride_tricks.as_strided(buffer[byte_ix[0]:], shape=(len(offsets), nbytes),
+                                               strides=(218, 1))
+    ix = np.minimum(byte_ix[:, np.newaxis] + np.arange(nbytes + 1), len(buffer) - 1)
+    raw = buffer[ix].astype(np.uint16)
+    words = (raw[:, :nbytes] << 8) | raw[:, 1:]
+    return ((words >> (8 - shift[:, np.newaxis])) & 0xFF).astype(np.uint8)
+
+
+def _get_field_(header, start, width):
+    """Returns the bits start to start + *width* of the 64 bit *header*
+    words as integers (lowest bit first).
+
+    """
+    return ((header >> np.uint64(start)) & np.uint64(2**width - 1)).astype(np.int64)
+
+
+def _decode_header_(result, ix, rows):
+    """Decodes the header fields of the valid buswords *rows* (see
+    _get_rows_) into the records *ix* of *result*.
+
+    """
+    # The bits of every byte have to be reversed (see page 2-12 in the
+    # manual and __rearrange_bits__), so the first 8 bytes read as little
+    # endian integer have the bits of the header in the right order.
+    header = np.ascontiguousarray(rows[:, :8]).view('<u8')[:, 0]
+    result['control_accept'][ix] = _get_field_(header, 8, 2)
+    result['slave'][ix] = _get_field_(header, 11, 1)
+    result['mode_annunciation'][ix] = _DECIMAL[_get_field_(header, 13, 5)].astype(np.byte)
+    result['faults'][ix] = _DECIMAL[_get_field_(header, 18, 7)].astype(np.byte)
+    result['stabilization'][ix] = _get_field_(header, 26, 1)
+    result['operating_mode'][ix] = _get_field_(header, 26, 3)
+    result['tilt'][ix] = _get_field_(header, 35, 1) * (-16) + _get_field_(header, 29, 6) * 0.25
+    result['gain'][ix] = _DECIMAL[_get_field_(header, 36, 6)]
+    result['range'][ix] = _RANGE_CODE[_get_field_(header, 42, 6)]
+    result['data_accept'][ix] = _get_field_(header, 49, 2)
+    result['scan_angle'][ix] = _get_field_(header, 51, 12) * 0.087890625
+
+
+def _get_labels_(rows):
+    """Returns the labels of the buswords *rows* as octal strings."""
+    return _OCTAL[(rows[:, 0].astype(np.int64) << 1) | (rows[:, 1] >> 7)]
+
+
+def _parse_file_(args):
+    """Pool helper for parse_file."""
+    filename, byte_range, offsets = args
+    buffer = np.memmap(filename, dtype=np.uint8, mode='r')[byte_range[0]:byte_range[1]]
+    return Arinc708().parse_many(buffer, offsets)
+
+
+@hot_path('parse_file')
+def parse_file(filename, offsets, byte_range=(0, None), workers=1):
+    """Parses the buswords at the bit offsets of a file, which is memory
+    mapped. The offsets are relative to the start of byte_range (see
+    Reader.byte_range). With workers > 1 the offsets are split into equal
+    parts, which are parsed in parallel processes.
+
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    if workers > 1 and len(offsets) > workers:
+        tasks = [(filename, byte_range, chunk) for chunk in np.array_split(offsets, workers)]
+        pool = multiprocessing.Pool(workers)
+        result = np.concatenate(pool.map(_parse_file_, tasks))
+        pool.close()
+        pool.join()
+        return result
+    return _parse_file_((filename, byte_range, offsets))
+
+
+def iter_headers(filename, offsets, byte_range=(0, None), block_size=_HEADER_BLOCK_SIZE):
+    """Yields the headers (see Arinc708.parse_headers) of the buswords at
+    the bit offsets of a memory mapped file in blocks of block_size
+    records, so that the memory does not depend on the size of the file.
+    The offsets are relative to the start of byte_range (see
+    Reader.byte_range).
+
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    buffer = np.memmap(filename, dtype=np.uint8, mode='r')[byte_range[0]:byte_range[1]]
+    arinc708 = Arinc708()
+    for i in range(0, len(offsets), block_size):
+        yield arinc708.parse_headers(buffer, offsets[i:i+block_size])
+
+
+@hot_path('parse_headers_file')
+def parse_headers_file(filename, offsets, byte_range=(0, None)):
+    """Parses the headers of all buswords at the bit offsets of a file (see
+    iter_headers).
+
+    """
+    headers = list(iter_headers(filename, offsets, byte_range))
+    if not headers:
+        return np.zeros(0, dtype=_HEADER.dtype)
+    return np.concatenate(headers)
 
 
 class Arinc708(object):
@@ -80,6 +236,7 @@ class Arinc708(object):
     def __init__(self):
         pass
 
+    @hot_path('Arinc708.parse')
     def parse(self, busword):
         """Module parses one (1600 bit long) ARINC708 message."""
         # convert the bitstring to a binary string
@@ -103,6 +260,70 @@ class Arinc708(object):
         self.Record['reflectivity'] = self.__get_reflectivity__()
         return self.Record
 
+    @hot_path('Arinc708.parse_many')
+    def parse_many(self, buffer, offsets):
+        """Parses many ARINC708 messages at once.
+
+        *buffer* is the raw content of a weather radar file as numpy uint8
+        array (e.g. np.fromfile or np.memmap) and *offsets* are the bit
+        positions of the buswords in it (see Reader.sIndexList). The result
+        is an array of the same dtype as the one that is returned by the
+        parse method and the decoded values are identical.
+
+        Buswords that are not valid keep all fields apart from the 'label'
+        zeroed. The label of buswords that run over the end of the buffer
+        is an empty string. The valid records are therefore those with
+        records['label'] == '550'.
+
+        """
+        buffer = np.asarray(buffer, dtype=np.uint8)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        result = np.zeros(len(offsets), dtype=_REC.dtype)
+        complete = np.where(offsets + 1600 <= len(buffer) * 8)[0]
+        for i in range(0, len(complete), _BLOCK_SIZE):
+            ix = complete[i:i+_BLOCK_SIZE]
+            rows = _get_rows_(buffer, offsets[ix])
+            label = _get_labels_(rows)
+            result['label'][ix] = label
+            valid = label == _LABEL
+            if not np.any(valid):
+                continue
+            ix, rows = ix[valid], rows[valid]
+            _decode_header_(result, ix, rows)
+            # After the reversal the data section is a little endian bit
+            # stream, i.e. every 3 bytes hold 8 gates of 3 bits each.
+            data = rows[:, 8:].reshape(-1, 64, 3).astype(np.uint32)
+            words = data[:, :, 0] | (data[:, :, 1] << 8) | (data[:, :, 2] << 16)
+            result['reflectivity'][ix] = ((words[:, :, np.newaxis] >> _GATE_SHIFT) & 7).reshape(-1, 512)
+        return result
+
+    @hot_path('Arinc708.parse_headers')
+    def parse_headers(self, buffer, offsets):
+        """Parses only the 64 bit headers of many ARINC708 messages.
+
+        Works like parse_many, but only the first 8 bytes of every busword
+        are read and the reflectivity is not decoded. The result has all
+        fields of the parse_many result apart from the reflectivity, which
+        makes it about ten times smaller, and the values are identical.
+        This is enough for e.g. the operating mode, range, tilt, scan angle
+        and faults of a whole flight.
+
+        """
+        buffer = np.asarray(buffer, dtype=np.uint8)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        result = np.zeros(len(offsets), dtype=_HEADER.dtype)
+        # the same records as for parse_many are complete
+        complete = np.where(offsets + 1600 <= len(buffer) * 8)[0]
+        for i in range(0, len(complete), _HEADER_BLOCK_SIZE):
+            ix = complete[i:i+_HEADER_BLOCK_SIZE]
+            rows = _get_rows_(buffer, offsets[ix], nbytes=8)
+            label = _get_labels_(rows)
+            result['label'][ix] = label
+            valid = label == _LABEL
+            if np.any(valid):
+                _decode_header_(result, ix[valid], rows[valid])
+        return result
+
     def __isvalid__(self, busword):
         """
         Check if the submitted bitstring is a valid ARINC708 busword.
@@ -5,8 +5,12 @@ Created on 3 Jan 2012
 '''
 
 import bitstring
+import multiprocessing
+import numpy as np
 import os
 
+from faam_wxrx.profiling import hot_path
+
 
 INFO_TEMPLATE = '\n' + (20*'#') + '\n' +\
 """File path: {Filepath}
@@ -21,27 +25,395 @@ Avg. record length: {self.rec_length}""" + \
 #length of a single wxrx data record
 _RECORD_LENGTH = 1744
 _LABEL = '550'
+# size of the byte blocks that are searched for labels in one go
+_SEARCH_BLOCK = 2**24
+# minimum number of records of a clean stretch that is not searched bit by bit
+_MIN_CLEAN_RUN = 16
+# version of the index sidecar files; older index files are ignored
+_INDEX_VERSION = 1
+
+
+@hot_path('find_labels')
+def find_labels(buffer, nbits, start=0, stop=None, shifts=range(8)):
+    """Finds all bit positions p (start <= p < stop) in the byte buffer
+    where the 9 bits from p on read as the label '550'. Only labels that
+    lie completely within the first nbits of the buffer are returned.
+
+    The search is done on the packed bytes: every label starts in byte k
+    and ends in byte k+1, so all eight possible bit shifts can be checked
+    on a 16 bit sliding window. With shifts=(0,) only the labels that
+    start at a byte boundary are looked for.
+
+    """
+    if stop is None:
+        stop = nbits
+    stop = min(stop, nbits - 8)
+    label = int(_LABEL, 8)
+    result = []
+    for block_start in range(start // 8, (stop + 7) // 8, _SEARCH_BLOCK):
+        block_end = min(block_start + _SEARCH_BLOCK, (stop + 7) // 8)
+        window = np.zeros(block_end - block_start, dtype=np.uint16)
+        window[:] = buffer[block_start:block_end]
+        window <<= 8
+        next_bytes = buffer[block_start+1:block_end+1]
+        window[:len(next_bytes)] |= next_bytes
+        for shift in shifts:
+            ix = np.where(((window >> (7 - shift)) & 0x1FF) == label)[0]
+            result.append((ix + block_start) * 8 + shift)
+    if not result:
+        return np.zeros(0, dtype=np.int64)
+    result = np.sort(np.concatenate(result)).astype(np.int64)
+    return result[(result >= start) & (result < stop)]
+
+
+def _find_labels_in_file_(args):
+    """Pool helper for Reader.parse: memory maps the file itself, so that
+    only the arguments have to be sent to the worker.
+
+    """
+    filename, byte_range, nbits, start, stop = args
+    buffer = np.memmap(filename, dtype=np.uint8, mode='r')[byte_range[0]:byte_range[1]]
+    return find_labels(buffer, nbits, start, stop)
+
+
+@hot_path('chain_records')
+def chain_records(labels, nbits, start=0):
+    """Returns the record positions and label errors from the positions of
+    all labels in the data.
+
+    Starting from the bit start (beginning of the data), a record is expected at the
+    current position, 144 bits later (the gap between two records) or, if
+    neither holds a label, at the next label. The following record is then
+    looked for 1600 bits (length of a busword) later. Since the next record
+    only depends on the position of the current one, the successor of every
+    label is worked out in one go and the chain is followed by pointer
+    doubling, which needs log2(number of records) steps.
+
+    """
+    labels = np.asarray(labels, dtype=np.int64)
+    n = len(labels)
+    nmax = int((nbits - start)/float(_RECORD_LENGTH))
+    if n == 0 or nmax <= 0:
+        return np.zeros(0, dtype=np.int64), []
+
+    def get_next(pos):
+        ix = np.searchsorted(labels, pos)
+        ix_gap = np.searchsorted(labels, pos + 144)
+        at_pos = labels[np.minimum(ix, n-1)] == pos
+        at_gap = labels[np.minimum(ix_gap, n-1)] == pos + 144
+        result = np.where(~at_pos & at_gap, ix_gap, ix)
+        # n marks the end of the chain
+        result[pos > nbits - 2000] = n
+        return result
+
+    on_chain = np.zeros(n + 1, dtype=bool)
+    on_chain[get_next(np.array([start], dtype=np.int64))] = True
+    jump = np.append(get_next(labels + 1600), n)
+    for i in range(int(np.ceil(np.log2(nmax))) + 1):
+        on_chain[jump[on_chain]] = True
+        jump = jump[jump]
+    sIndexList = labels[on_chain[:n]][:nmax]
+
+    expected = np.append(start, sIndexList[:-1] + 1600)
+    offset = sIndexList - expected
+    errors = [('label error', int(i), int(offset[i]))
+              for i in np.where((offset != 0) & (offset != 144))[0]]
+    return sIndexList, errors
+
+
+def _contains_(values, x):
+    """Returns for every x whether it is in the sorted array values."""
+    if len(values) == 0:
+        return np.zeros(np.shape(x), dtype=bool)
+    return values[np.minimum(np.searchsorted(values, x), len(values) - 1)] == x
+
+
+def _merge_ranges_(start, end):
+    """Joins overlapping bit ranges [start, end)."""
+    if len(start) == 0:
+        return start, end
+    order = np.argsort(start)
+    start, end = start[order], np.maximum.accumulate(end[order])
+    new = np.append(True, start[1:] > end[:-1])
+    last = np.append(np.where(new)[0][1:] - 1, len(start) - 1)
+    return start[new], end[last]
+
+
+def _get_gaps_(start, end, nbits):
+    """Returns the bit ranges between the sorted ranges [start, end) as a
+    list of (start, stop) tuples.
+
+    """
+    gaps = zip(np.append(0, end).tolist(), np.append(start, nbits).tolist())
+    return [(a, b) for a, b in gaps if b > a]
+
+
+def _split_ranges_(ranges, parts):
+    """Cuts the bit ranges into pieces, so that the work can be shared by
+    the given number of processes.
+
+    """
+    size = max(sum([b - a for a, b in ranges]) // parts, 8)
+    return [(i, min(i + size, b)) for a, b in ranges for i in range(a, b, size)]
+
+
+def find_clean_runs(aligned, min_length=_MIN_CLEAN_RUN):
+    """Returns the start and end bit positions of the clean stretches of
+    the data, in which records follow each other at byte boundaries and
+    exactly 1744 bits apart, from the positions of all byte aligned labels.
+
+    A label is clean if there is another label 1744 bits later, but none
+    1600 bits later: the next record is then known without looking at any
+    of the labels in between. Only stretches of at least min_length clean
+    labels are returned.
+
+    """
+    aligned = np.asarray(aligned, dtype=np.int64)
+    clean = aligned[_contains_(aligned, aligned + _RECORD_LENGTH) &
+                    ~_contains_(aligned, aligned + 1600)]
+    if len(clean) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    # the labels of a stretch all have the same remainder modulo the record length
+    clean = clean[np.lexsort((clean, clean % _RECORD_LENGTH))]
+    breaks = np.where(np.diff(clean) != _RECORD_LENGTH)[0] + 1
+    first = np.append(0, breaks)
+    last = np.append(breaks, len(clean)) - 1
+    keep = (last - first + 1) >= min_length
+    return _merge_ranges_(clean[first[keep]], clean[last[keep]] + _RECORD_LENGTH)
+
+
+def _check_chain_(labels, sIndexList, skip_start, skip_end, nbits, start=0):
+    """Returns for every skipped bit range [skip_start, skip_end) whether
+    the record chain depends on labels in it that have not been looked
+    for, i.e. labels that do not start at a byte boundary.
+
+    """
+    unsafe = np.zeros(len(skip_start), dtype=bool)
+    if len(skip_start) == 0 or len(labels) == 0:
+        return unsafe
+    # positions at which chain_records looked for the next record
+    pos = np.append(start, np.asarray(sIndexList, dtype=np.int64) + 1600)
+    pos = pos[pos <= nbits - 2000]
+
+    def get_skipped(p):
+        ix = np.searchsorted(skip_start, p, side='right') - 1
+        inside = (ix >= 0) & (p < skip_end[np.maximum(ix, 0)]) & (p % 8 != 0)
+        return ix[inside]
+
+    at_pos = _contains_(labels, pos)
+    at_gap = _contains_(labels, pos + 144)
+    unsafe[get_skipped(pos[~at_pos])] = True
+    unsafe[get_skipped(pos[~at_pos & ~at_gap] + 144)] = True
+    # the chain jumped to the next known label; no skipped range may lie in between
+    pos = pos[~at_pos & ~at_gap]
+    ix = np.searchsorted(labels, pos)
+    following = np.where(ix < len(labels), labels[np.minimum(ix, len(labels) - 1)], nbits)
+    lo = np.searchsorted(skip_end, pos, side='right')
+    hi = np.searchsorted(skip_start, following)
+    for a, b in zip(lo[lo < hi], hi[lo < hi]):
+        unsafe[a:b] = True
+    return unsafe
+
+
+@hot_path('find_records')
+def find_records(buffer, nbits, search=None, start=0):
+    """Returns the record positions and label errors like chain_records,
+    but only searches the data bit by bit where it has to.
+
+    Most of the data are clean stretches of byte aligned records (see
+    find_clean_runs), which are found by looking for byte aligned labels
+    only. The full search is limited to the remaining bit ranges;
+    search(ranges) returns the labels in a list of (start, stop) ranges and
+    defaults to find_labels on the buffer. If the record chain passes a
+    clean stretch in a way that depends on labels that have not been looked
+    for, that stretch is searched as well and the chain is worked out
+    again. The result is therefore always the same as from chain_records
+    on all labels. start is the bit at which the chain starts.
+
+    """
+    if search is None:
+        def search(ranges):
+            return np.concatenate([np.zeros(0, dtype=np.int64)] +
+                                  [find_labels(buffer, nbits, a, b) for a, b in ranges])
+    aligned = find_labels(buffer, nbits, shifts=(0,))
+    skip_start, skip_end = find_clean_runs(aligned)
+    labels = np.union1d(aligned, search(_get_gaps_(skip_start, skip_end, nbits)))
+    while True:
+        sIndexList, errors = chain_records(labels, nbits, start)
+        unsafe = _check_chain_(labels, sIndexList, skip_start, skip_end, nbits, start)
+        if not np.any(unsafe):
+            return sIndexList, errors
+        ranges = list(zip(skip_start[unsafe].tolist(), skip_end[unsafe].tolist()))
+        labels = np.union1d(labels, search(ranges))
+        skip_start, skip_end = skip_start[~unsafe], skip_end[~unsafe]
+
+
+def get_index_filename(infile):
+    """Returns the path of the index sidecar file of a tmp-file."""
+    return infile + '.idx.npz'
+
+
+def load_index(infile, file_size, mtime):
+    """Returns the record positions and label errors of a tmp-file from its
+    index sidecar file as tuple (sIndexList, error_index, error_offset).
+
+    None is returned if there is no index or if it is not valid anymore,
+    i.e. if it was written for another size or modification time of the
+    tmp-file.
+
+    """
+    index_file = get_index_filename(infile)
+    if not os.path.exists(index_file):
+        return None
+    try:
+        index = np.load(index_file)
+        try:
+            if (int(index['version']) != _INDEX_VERSION or
+                    int(index['file_size']) != file_size or
+                    float(index['mtime']) != mtime):
+                return None
+            return index['sIndexList'], index['error_index'], index['error_offset']
+        finally:
+            index.close()
+    except Exception:
+        # a broken index file is ignored and written again
+        return None
+
+
+def save_index(infile, file_size, mtime, sIndexList, errors):
+    """Writes the record positions and label errors of a complete tmp-file
+    to its index sidecar file. Nothing happens if the file can not be
+    written, e.g. in a read-only data directory.
+
+    """
+    try:
+        np.savez(get_index_filename(infile),
+                 version=_INDEX_VERSION,
+                 file_size=file_size,
+                 mtime=mtime,
+                 sIndexList=np.asarray(sIndexList, dtype=np.int64),
+                 error_index=np.array([e[1] for e in errors], dtype=np.int64),
+                 error_offset=np.array([e[2] for e in errors], dtype=np.int64))
+    except (IOError, OSError):
+        pass
+
+
+class MappedBuswords(object):
+    """Read-only sequence of the buswords of a memory mapped Reader.
+
+    Nothing is copied until a busword is accessed. Every item is then
+    created as a bitstring from the (zero-copy) numpy view of the mapped
+    file at the bit offset of the record.
+
+    """
+
+    def __init__(self, data, nbits, sIndexList):
+        self.data = data
+        self.nbits = nbits
+        self.sIndexList = sIndexList
+
+    def __len__(self):
+        return len(self.sIndexList)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        ix = int(self.sIndexList[i])
+        length = min(1600, self.nbits - ix)
+        view = self.data[ix // 8:(ix + length + 7) // 8]
+        return bitstring.Bits(bytes=view.tobytes(), offset=ix % 8, length=length)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
 
 
 class Reader(object):
 
-    def __init__(self, infile, start=None, length=None):
+    def __init__(self, infile, start=None, length=None, use_mmap=False, use_index=True, write_index=True):
         """Reader class for temporary weather-radar-data files.
 
         start and length units are records
+
+        With use_mmap the file is memory mapped with numpy instead of being
+        loaded as one bitstring. The records are then only read from disk
+        when they are accessed, which keeps the memory footprint small for
+        large temp files.
+
+        With use_index the record positions are taken from the index
+        sidecar file of the tmp-file (see load_index) if it is still valid,
+        and the index is written after the whole file has been parsed
+        (unless write_index is False, e.g. for a read-only check).
+        start and length then select the records directly by their number
+        without searching through the file. Without an index the whole file
+        is searched and the same records are cut out of the record chain.
         """
         self.Filename = infile
-        self.file_size = os.stat(self.Filename).st_size
-        self.Fulldata = bitstring.Bits(filename=infile)
+        stat = os.stat(self.Filename)
+        self.file_size = stat.st_size
+        self.mtime = stat.st_mtime
+        self.use_mmap = use_mmap
+        self.use_index = use_index
+        self.write_index = write_index
+        if use_mmap:
+            self.Fulldata = np.memmap(infile, dtype=np.uint8, mode='r')
+            nbits = len(self.Fulldata) * 8
+        else:
+            self.Fulldata = bitstring.Bits(filename=infile)
+            nbits = len(self.Fulldata)
+
+        self.Index = None
+        if use_index:
+            self.Index = load_index(infile, self.file_size, self.mtime)
+        self.Window = (start, length) if start is not None and length is not None else None
 
-        if start and length:
-            self.Data = self.Fulldata[start * _RECORD_LENGTH:(start * _RECORD_LENGTH) + (length+1 * _RECORD_LENGTH)]
+        if self.Window and self.Index is not None:
+            self.__set_window__(self.Index[0])
         else:
-            self.Data = self.Fulldata
+            # without an index the whole file is searched and the window is
+            # cut out of the record chain in parse
+            self.__set_range__(0, nbits)
 
         self.Errors, self.Buswords, self.Records, self.sIndexList = [], [], [], []
         self._sIndex, self.NRecords = 0, 0
 
+    def __set_range__(self, bit_start, bit_end):
+        self.NBits = max(bit_end - bit_start, 0)
+        # bit_start is always at a byte boundary
+        self.bit_start = bit_start
+        # bytes of the file that hold the data
+        self.byte_range = (bit_start // 8, (bit_end + 7) // 8)
+        if self.use_mmap:
+            self.Data = self.Fulldata[self.byte_range[0]:self.byte_range[1]]
+        elif self.Window:
+            self.Data = self.Fulldata[bit_start:bit_end]
+        else:
+            self.Data = self.Fulldata
+
+    def __set_window__(self, sIndexList):
+        """Limits the data to the records of the window, given the record
+        positions of the whole file.
+
+        """
+        start, length = self.Window
+        positions = sIndexList[start:start+length]
+        if len(positions) > 0:
+            bit_start = int(positions[0]) // 8 * 8
+            bit_end = min(int(positions[-1]) + 1600, self.file_size * 8)
+        else:
+            bit_start, bit_end = 0, 0
+        self.__set_range__(bit_start, bit_end)
+
+    def get_buffer(self):
+        """Returns the data as numpy uint8 array. Bit offsets from the
+        sIndexList refer to this buffer, which can be passed on to
+        Arinc708.parse_many or Arinc708.parse_headers.
+
+        """
+        if self.use_mmap:
+            return self.Data
+        return np.frombuffer(self.Data.tobytes(), dtype=np.uint8)
+
     def get_data(self):
         result = {}
         result['Errors'] = self.Errors
@@ -51,39 +423,71 @@ class Reader(object):
         result['_sIndex'] = self._sIndex
         return result
 
-    def __get_offset__(self, start_ix):
-        i = 144
-        if str(self.Data[start_ix+i:start_ix+i+9].oct) == _LABEL:
-            return i
-        i = 0
-        while True:
-            if start_ix+i+9 > len(self.Data):
-                break
-            if str(self.Data[start_ix+i:start_ix+i+9].oct) == _LABEL:
-                return i
-            else:
-                i += 1
-
-    def parse(self):
-        #n = int(float(os.stat(self.Filename).st_size) / 200.)
-        n = int(len(self.Data)/float(_RECORD_LENGTH))
-
-        for i in range(0, n):
-            if self._sIndex > (len(self.Data) - 2000):
-                break
-            rec = self.Data[self._sIndex:self._sIndex + 1600]
-            if not str(rec[0:9].oct) == _LABEL:
-                offset = self.__get_offset__(self._sIndex)
-                self._sIndex += offset
-                if offset != 144 and offset != 0:
-                    self.Errors.append(('label error', i, offset))
-            try:
-                self.Buswords.append(self.Data[self._sIndex:self._sIndex+1600])
-                self.sIndexList.append(self._sIndex)
-            except:
-                pass
-            self._sIndex += 1600
-            self.NRecords += 1
+    @hot_path('Reader.parse')
+    def parse(self, workers=1, pool=None):
+        """Finds the position of all records in the data.
+
+        Clean stretches of byte aligned records are found without a bit
+        by bit search (see find_records). With workers > 1 the rest of the
+        data is cut into pieces, which are searched for labels in parallel
+        processes. Every label belongs to the piece in which it starts, so
+        joining the pieces gives exactly the labels of a single search and
+        the record chain is the same as for a serial run. If a
+        multiprocessing pool is passed in, it is used instead of starting
+        a new one.
+
+        If a valid index of the file was loaded, the positions are taken
+        from the index instead.
+
+        """
+        if self.Index is not None:
+            index = self.Index
+        else:
+            sIndexList, errors = self.__find_records__(workers, pool)
+            if self.use_index and self.write_index:
+                save_index(self.Filename, self.file_size, self.mtime, sIndexList, errors)
+            index = (np.asarray(sIndexList, dtype=np.int64),
+                     np.array([e[1] for e in errors], dtype=np.int64),
+                     np.array([e[2] for e in errors], dtype=np.int64))
+            if self.Window:
+                self.__set_window__(index[0])
+        self.sIndexList, self.Errors = self.__get_records__(index)
+        self.NRecords = len(self.sIndexList)
+        if self.NRecords > 0:
+            self._sIndex = int(self.sIndexList[-1]) + 1600
+        if self.use_mmap:
+            self.Buswords = MappedBuswords(self.Data, self.NBits, self.sIndexList)
+        else:
+            self.Buswords = [self.Data[ix:ix+1600] for ix in self.sIndexList]
+
+    def __find_records__(self, workers, pool=None):
+        search, own_pool = None, None
+        if workers > 1:
+            if pool is None:
+                pool = own_pool = multiprocessing.Pool(workers)
+
+            def search(ranges):
+                tasks = [(self.Filename, self.byte_range, self.NBits, a, b)
+                         for a, b in _split_ranges_(ranges, workers)]
+                return np.concatenate([np.zeros(0, dtype=np.int64)] +
+                                      pool.map(_find_labels_in_file_, tasks))
+        result = find_records(self.get_buffer(), self.NBits, search)
+        if own_pool:
+            own_pool.close()
+            own_pool.join()
+        return result
+
+    def __get_records__(self, index):
+        sIndexList, error_index, error_offset = index
+        if self.Window:
+            start, length = self.Window
+            sIndexList = sIndexList[start:start+length] - self.bit_start
+            # the first record of the window is always where it is expected
+            keep = (error_index > start) & (error_index < start + length)
+            error_index, error_offset = error_index[keep] - start, error_offset[keep]
+        errors = [('label error', int(i), int(offset))
+                  for i, offset in zip(error_index, error_offset)]
+        return sIndexList, errors
 
     def __str__(self):
         # TODO: add ERORR to the output
@@ -1,2 +1,265 @@
-#TODO
-#Creates summary of weather radar netcdf file
\ No newline at end of file
+#!/usr/bin/python
+
+"""
+Creates a summary of a weather radar netCDF.
+
+The netCDF is read in chunks of records along the time dimension, so the
+memory does not depend on the length of the flight; the reflectivity of a
+chunk of 16384 records takes 8MB. The summary covers
+
+  coverage       first and last record, number of records, time with
+                 records and the longest gaps
+  distributions  number of records for every operating mode, range and
+                 tilt
+  faults         number of records, first and last time of every fault
+  reflectivity   share of the gates in every class (0-7, see the
+                 reflectivity description in the netCDF) for the whole
+                 flight and for every interval of e.g. 60 seconds
+
+and is written as text or JSON, e.g.
+
+    python -m faam_wxrx.Summary weather-radar_faam_20120102_r0_b655.nc --json summary.json
+
+"""
+
+import collections
+import datetime
+import heapq
+import json
+import sys
+import netCDF4
+import numpy as np
+
+from .Arinc708 import unwrap_bits
+from .utils import add_counts
+
+# records that are read in one go; a multiple of the chunking of the
+# netCDF (see Writer.STORAGE_PROFILES)
+CHUNK_SIZE = 2**14
+# seconds without records that are counted as gap
+MIN_GAP = 2.
+# seconds of the intervals of the reflectivity classes
+INTERVAL = 60.
+# number of gaps that are listed
+MAX_GAPS = 20
+# bytes of the HDF5 chunk cache of the reflectivity
+_CHUNK_CACHE = 2**22
+
+# faults for the bits 18 to 24 of the busword (see Arinc708.__get_faults__)
+FAULTS = ('Cooling fault', 'Display fault', 'Calibration fault [T-R]', 'Altitude input fault',
+          'Control fault', 'Antenna fault', 'Transmitter/receiver fault')
+# number of reflectivity classes
+CLASSES = 8
+
+
+def _sorted_(counts):
+    return collections.OrderedDict([(str(k), counts[k]) for k in sorted(counts)])
+
+
+class Summary(object):
+    """Summary of a weather radar netCDF (see module documentation).
+
+    chunk_size is the number of records that are read at once, gaps
+    without records longer than min_gap seconds are reported and the
+    reflectivity classes are counted for every interval seconds.
+
+    """
+
+    def __init__(self, ncfile, chunk_size=CHUNK_SIZE, min_gap=MIN_GAP, interval=INTERVAL):
+        self.Ncfile = ncfile
+        self.Chunk_size = chunk_size
+        self.Min_gap = min_gap
+        self.Interval = interval
+        self.Base_time = None
+        self.Records = 0
+        self.Start, self.End = None, None
+        # number and length of all gaps and the longest ones as
+        # (seconds, start, end)
+        self.Gaps, self.Gap_seconds, self.Longest_gaps = 0, 0., []
+        self.Distributions = dict([(name, {}) for name in ('operating_mode', 'range', 'tilt')])
+        # [records, first time, last time] of every fault
+        self.Faults = [[0, None, None] for name in FAULTS]
+        self.Fault_records = 0
+        # gates per class for the whole flight and for every interval
+        self.Classes = np.zeros(CLASSES, dtype=np.int64)
+        self.Intervals = {}
+        self.Sweeps = 0
+
+    def create(self):
+        """Reads the netCDF and collects the summary."""
+        ds = netCDF4.Dataset(self.Ncfile, 'r')
+        try:
+            time_var = ds.variables['time']
+            units = getattr(time_var, 'units', '')
+            if units:
+                self.Base_time = netCDF4.num2date(0, units)
+            self.Sweeps = len(ds.dimensions['sweep']) if 'sweep' in ds.dimensions else 0
+            refl_var = ds.variables['reflectivity']
+            # the gates are not masked, which would double the memory, and
+            # the records are read only once, so the chunk cache can be small
+            refl_var.set_auto_mask(False)
+            refl_var.set_var_chunk_cache(size=_CHUNK_CACHE)
+            last = None
+            for i in range(0, len(time_var), self.Chunk_size):
+                time = np.ma.filled(np.ma.asarray(time_var[i:i+self.Chunk_size], dtype=float), np.nan)
+                ok = np.isfinite(time)
+                if not np.any(ok):
+                    continue
+                last = self.__add_coverage__(time[ok], last)
+                for name in self.Distributions:
+                    add_counts(self.Distributions[name], np.ma.compressed(ds.variables[name][i:i+self.Chunk_size][ok]))
+                self.__add_faults__(time[ok], np.ma.filled(ds.variables['faults'][i:i+self.Chunk_size], 0)[ok])
+                self.__add_reflectivity__(time[ok], refl_var[i:i+self.Chunk_size][ok])
+        finally:
+            ds.close()
+
+    def __add_coverage__(self, time, last):
+        self.Records += len(time)
+        if self.Start is None:
+            self.Start, self.End = time[0], time[0]
+        self.Start, self.End = min(self.Start, np.min(time)), max(self.End, np.max(time))
+        # the gap between two chunks is found with the last time before
+        if last is not None:
+            time = np.append(last, time)
+        diff = np.diff(time)
+        for k in np.where(diff > self.Min_gap)[0]:
+            self.Gaps += 1
+            self.Gap_seconds += diff[k]
+            gap = (float(diff[k]), float(time[k]), float(time[k+1]))
+            if len(self.Longest_gaps) < MAX_GAPS:
+                heapq.heappush(self.Longest_gaps, gap)
+            else:
+                heapq.heappushpop(self.Longest_gaps, gap)
+        return time[-1]
+
+    def __add_faults__(self, time, faults):
+        bits = unwrap_bits(faults)
+        self.Fault_records += int(np.sum(bits != 0))
+        for k in range(len(FAULTS)):
+            ix = np.where(bits & (1 << k))[0]
+            if len(ix) == 0:
+                continue
+            fault = self.Faults[k]
+            fault[0] += len(ix)
+            fault[1] = time[ix[0]] if fault[1] is None else min(fault[1], time[ix[0]])
+            fault[2] = time[ix[-1]] if fault[2] is None else max(fault[2], time[ix[-1]])
+
+    def __add_reflectivity__(self, time, refl):
+        # gates of every class per record; one class at a time keeps the
+        # temporary arrays at the size of the chunk
+        refl = np.asarray(refl) & 7
+        interval = np.floor(time / self.Interval).astype(np.int64)
+        keys, ix = np.unique(interval, return_inverse=True)
+        counts = np.zeros((len(keys), CLASSES), dtype=np.int64)
+        for c in range(CLASSES):
+            per_record = np.sum(refl == c, axis=1)
+            counts[:, c] = np.bincount(ix, weights=per_record, minlength=len(keys)).astype(np.int64)
+        self.Classes += counts.sum(axis=0)
+        for key, row in zip(keys.tolist(), counts):
+            if key in self.Intervals:
+                self.Intervals[key] += row
+            else:
+                self.Intervals[key] = row
+
+    def __format_time__(self, secs):
+        if secs is None:
+            return None
+        if self.Base_time is None:
+            return '%.1f' % secs
+        return (self.Base_time + datetime.timedelta(seconds=float(secs))).strftime('%Y-%m-%d %H:%M:%S')
+
+    def get_report(self):
+        """Returns the summary as dictionary."""
+        report = collections.OrderedDict()
+        report['file'] = self.Ncfile
+        coverage = collections.OrderedDict()
+        coverage['records'] = self.Records
+        coverage['start'] = self.__format_time__(self.Start)
+        coverage['end'] = self.__format_time__(self.End)
+        duration = (self.End - self.Start) if self.Records else 0.
+        coverage['duration'] = duration
+        coverage['covered'] = duration - self.Gap_seconds
+        coverage['sweeps'] = self.Sweeps
+        coverage['gaps'] = self.Gaps
+        coverage['gap_seconds'] = self.Gap_seconds
+        coverage['longest_gaps'] = [collections.OrderedDict([('start', self.__format_time__(start)),
+                                                             ('end', self.__format_time__(end)),
+                                                             ('seconds', secs)])
+                                     for secs, start, end in sorted(self.Longest_gaps, reverse=True)]
+        report['coverage'] = coverage
+        report['distributions'] = collections.OrderedDict([(name, _sorted_(self.Distributions[name]))
+                                                           for name in ('operating_mode', 'range', 'tilt')])
+        faults = collections.OrderedDict()
+        faults['records'] = self.Fault_records
+        for name, (n, first, last) in zip(FAULTS, self.Faults):
+            faults[name] = collections.OrderedDict([('records', n),
+                                                    ('first', self.__format_time__(first)),
+                                                    ('last', self.__format_time__(last))])
+        report['faults'] = faults
+        total = max(int(self.Classes.sum()), 1)
+        report['reflectivity'] = collections.OrderedDict([(str(c), self.Classes[c] / float(total))
+                                                          for c in range(CLASSES)])
+        report['interval'] = self.Interval
+        report['reflectivity_intervals'] = [
+            collections.OrderedDict([('start', self.__format_time__(key * self.Interval))] +
+                                    [(str(c), row[c] / float(max(row.sum(), 1))) for c in range(CLASSES)])
+            for key, row in sorted(self.Intervals.items())]
+        return report
+
+    def write_report(self, filename):
+        """Writes the summary as JSON."""
+        f = open(filename, 'w')
+        try:
+            json.dump(self.get_report(), f, indent=2)
+            f.write('\n')
+        finally:
+            f.close()
+
+    def __str__(self):
+        report = self.get_report()
+        coverage = report['coverage']
+        lines = ['#' * 20, 'File: %s' % self.Ncfile,
+                 'Records: %i' % coverage['records'],
+                 'Time: %s - %s (%.0f secs, %.0f secs with data)' %
+                 (coverage['start'], coverage['end'], coverage['duration'], coverage['covered']),
+                 'Sweeps: %i' % coverage['sweeps'],
+                 'Gaps > %.0f secs: %i (%.0f secs)' % (self.Min_gap, coverage['gaps'], coverage['gap_seconds'])]
+        for gap in coverage['longest_gaps']:
+            lines.append('  %s - %s (%.0f secs)' % (gap['start'], gap['end'], gap['seconds']))
+        for name, counts in report['distributions'].items():
+            lines.append('%s: %s' % (name, ', '.join(['%s:%i' % (k, n) for k, n in counts.items()])))
+        lines.append('Records with faults: %i' % report['faults']['records'])
+        for name in FAULTS:
+            fault = report['faults'][name]
+            if fault['records']:
+                lines.append('  %s: %i (%s - %s)' % (name, fault['records'], fault['first'], fault['last']))
+        lines.append('Reflectivity: %s' % ', '.join(['%s:%.4f' % (k, v) for k, v in report['reflectivity'].items()]))
+        lines.append('%-19s %s' % ('interval start', ' '.join(['%7i' % c for c in range(CLASSES)])))
+        for row in report['reflectivity_intervals']:
+            lines.append('%-19s %s' % (row['start'], ' '.join(['%7.4f' % row[str(c)] for c in range(CLASSES)])))
+        lines.append('#' * 20)
+        return '\n'.join(lines) + '\n'
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('ncfile', action="store", type=str,
+                        help='weather radar netCDF')
+    parser.add_argument('--json', dest='json', action="store", type=str, default=None,
+                        help='JSON file for the summary')
+    parser.add_argument('-i', '--interval', dest='interval', action="store", type=float, default=INTERVAL,
+                        help='seconds of the intervals of the reflectivity classes [default: %.0f]' % INTERVAL)
+    parser.add_argument('--min-gap', dest='min_gap', action="store", type=float, default=MIN_GAP,
+                        help='seconds without records that are counted as gap [default: %.0f]' % MIN_GAP)
+    parser.add_argument('-q', '--quiet', dest='quiet', action="store_true",
+                        help='do not print the summary')
+    args = parser.parse_args()
+    summary = Summary(args.ncfile, min_gap=args.min_gap, interval=args.interval)
+    summary.create()
+    if not args.quiet:
+        sys.stdout.write(str(summary))
+    if args.json:
+        summary.write_report(args.json)
+        sys.stdout.write('Summary written to ... %s\n' % (args.json))
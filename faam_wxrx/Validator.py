@@ -1,46 +1,229 @@
-'''
-Created on 7 Nov 2011
+#!/usr/bin/python
 
-@author: axel
-'''
+"""
+Checks the integrity of weather radar tmp-files, e.g. of a whole campaign
+archive.
 
-import bitstring
+Every tmp-file below the given paths is checked in a pool of worker
+processes. The record positions are found with the fast sync of the
+Reader (or taken from its index) and only the headers of the records are
+decoded (see Arinc708.parse_headers). The index of a tmp-file is only
+written with --write-index, so the checked archive is not changed. For
+every file the following is reported:
+
+  records            number of record positions that were found
+  valid              records with the label '550'
+  incomplete         records that run over the end of the file
+  decodable_fraction share of the file that is covered by valid records
+                     (including the gap after every record)
+  sync_losses        places where the record chain was lost and found
+                     again (see Reader.Errors) with the record number, the
+                     bit offset of the record in the file and the skipped
+                     bits between the end of the record before and it
+                     (normally 0 or 144)
+  histograms         counts of the values of the header fields of the
+                     valid records (scan angle in 10 degree bins, mode
+                     annunciation and faults as bit patterns, e.g. 5 for
+                     the bits 101)
+
+Files that can not be read are reported with the error and do not stop the
+check of the other files.
+
+"""
+
+import collections
+import fnmatch
+import json
+import multiprocessing
 import os
-import pprint
 import sys
+import numpy as np
 
-from faam_wxrx.Arinc708 import Arinc708
-from faam_wxrx.Reader import Reader
+from .Arinc708 import iter_headers, unwrap_bits
+from .Reader import Reader, _RECORD_LENGTH
+from .utils import add_counts
 
+# header fields of which the values are counted
+HISTOGRAM_FIELDS = ('control_accept', 'slave', 'mode_annunciation', 'faults', 'stabilization',
+                    'operating_mode', 'tilt', 'gain', 'range', 'data_accept', 'scan_angle')
+# header fields that are counted by their bit patterns (see
+# Arinc708.unwrap_bits)
+BIT_FIELDS = ('mode_annunciation', 'faults')
+# width of the scan angle bins in degrees
+SCAN_ANGLE_BIN = 10.
+# number of sync losses that are listed in the text output
+_MAX_LISTED = 10
 
-def Validator( infile ):
 
-    #infile = os.path.join( ROOT_PATH, fname )
-    #val = Validator( infile )
-    val.check_records( )
-    val.close( )
-    print( '\n' + 30 * '#' )
-    print( infile )
-    val.print_info()
-    pprint.pprint( val.Errors )
+def find_tmp_files(paths, pattern='*.tmp'):
+    """Returns the sorted paths of all files matching pattern (case
+    insensitive) in and below the given files or directories.
 
-    gix, bix = [], []
-    valid, not_valid = 0, 0
-    not_valid = 0
-    for i in range( len( val.Records )):
-        ar = Arinc708()
-        try:
-            tmp = ar.parse( val.Records[i][1] )
-            gix.append( i )
-            valid += 1
-        except:
-            not_valid += 1
-            bix.append( i )
-    print( 'valid:' + str( valid) )
-    print( 'not_valid:' + str( not_valid ))
-    print( 30 * '#' + '\n' )
+    """
+    result = []
+    for path in paths:
+        if os.path.isfile(path):
+            result.append(path)
+            continue
+        for root, dirs, files in os.walk(path):
+            result.extend([os.path.join(root, f) for f in files
+                           if fnmatch.fnmatch(f.lower(), pattern.lower())])
+    return sorted(result)
+
+
+def validate_file(filename, use_index=True, write_index=False):
+    """Checks a single tmp-file and returns the result as dictionary (see
+    module documentation). With use_index the record positions are taken
+    from the index of the file (see Reader.load_index), if it has one, and
+    with write_index the index is written if there is none.
+
+    """
+    result = collections.OrderedDict()
+    result['file'] = filename
+    try:
+        result['file_size'] = os.path.getsize(filename)
+        if result['file_size'] == 0:
+            raise ValueError('empty file')
+        reader = Reader(filename, use_mmap=True, use_index=use_index, write_index=write_index)
+        reader.parse()
+        sIndexList = np.asarray(reader.sIndexList, dtype=np.int64)
+        # the record chain only starts records at labels, so every record
+        # is either valid or runs over the end of the file
+        valid, incomplete = 0, 0
+        histograms = dict([(name, {}) for name in HISTOGRAM_FIELDS])
+        # the headers are decoded in blocks, so that the memory does not
+        # depend on the size of the file
+        for headers in iter_headers(filename, sIndexList, reader.byte_range):
+            ok = headers['label'] == '550'
+            valid += int(np.sum(ok))
+            incomplete += int(np.sum(headers['label'] == ''))
+            for name in HISTOGRAM_FIELDS:
+                values = headers[name][ok]
+                if name == 'scan_angle':
+                    values = np.floor(values / SCAN_ANGLE_BIN) * SCAN_ANGLE_BIN
+                elif name in BIT_FIELDS:
+                    values = unwrap_bits(values)
+                add_counts(histograms[name], values)
+        result['records'] = len(sIndexList)
+        result['valid'] = valid
+        result['incomplete'] = incomplete
+        result['decodable_fraction'] = min(valid * _RECORD_LENGTH / 8. / result['file_size'], 1.)
+        # every error is the record from which on the chain was found again
+        # and the number of bits between it and the end of the record before
+        result['sync_losses'] = [collections.OrderedDict([('record', i),
+                                                          ('bit', int(sIndexList[i]) + reader.bit_start),
+                                                          ('skipped_bits', offset)])
+                                 for name, i, offset in reader.Errors]
+        result['skipped_bits'] = sum([e['skipped_bits'] for e in result['sync_losses']])
+        result['histograms'] = collections.OrderedDict(
+            [(name, collections.OrderedDict([(str(k), histograms[name][k]) for k in sorted(histograms[name])]))
+             for name in HISTOGRAM_FIELDS])
+        result['error'] = None
+    except Exception as e:
+        result['error'] = '%s: %s' % (type(e).__name__, e)
+    return result
+
+
+def _validate_file_(args):
+    """Pool helper for validate_file."""
+    return validate_file(*args)
 
 
-wxrx_file = '/home/axel/wxrx_tmp/B655/COP13B.tmp'
+def validate(files, workers=1, use_index=True, write_index=False):
+    """Checks the files in a pool of worker processes and yields the
+    results (see validate_file) in the order of the files.
+
+    """
+    tasks = [(f, use_index, write_index) for f in files]
+    if workers <= 1:
+        for task in tasks:
+            yield _validate_file_(task)
+        return
+    pool = multiprocessing.Pool(workers)
+    try:
+        for result in pool.imap(_validate_file_, tasks):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def get_totals(results):
+    """Returns the sums of the counts of all results."""
+    totals = collections.OrderedDict()
+    totals['files'] = len(results)
+    totals['errors'] = len([r for r in results if r['error']])
+    for key in ('file_size', 'records', 'valid', 'incomplete', 'skipped_bits'):
+        totals[key] = sum([r.get(key, 0) for r in results])
+    totals['sync_losses'] = sum([len(r.get('sync_losses', [])) for r in results])
+    return totals
+
+
+def format_result(result):
+    """Returns the result of a file as text."""
+    lines = ['#' * 20, 'File: %s' % result['file']]
+    if result['error']:
+        lines.extend(['Error: %s' % result['error'], '#' * 20])
+        return '\n'.join(lines) + '\n'
+    lines.append('File size: %i bytes' % result['file_size'])
+    lines.append('Records: %i (valid: %i, incomplete: %i)' %
+                 (result['records'], result['valid'], result['incomplete']))
+    lines.append('Decodable: %.2f%%' % (result['decodable_fraction'] * 100.))
+    lines.append('Sync losses: %i (skipped bits: %i)' % (len(result['sync_losses']), result['skipped_bits']))
+    for e in result['sync_losses'][:_MAX_LISTED]:
+        lines.append('  record %i at bit %i: %i bits' % (e['record'], e['bit'], e['skipped_bits']))
+    if len(result['sync_losses']) > _MAX_LISTED:
+        lines.append('  ...')
+    for name, counts in result['histograms'].items():
+        lines.append('%s: %s' % (name, ', '.join(['%s:%i' % (k, n) for k, n in counts.items()])))
+    lines.append('#' * 20)
+    return '\n'.join(lines) + '\n'
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', action="store", type=str, nargs='+',
+                        help='tmp-files or directories that are searched for tmp-files')
+    parser.add_argument('-w', '--workers', dest='workers', action="store",
+                        type=int, default=multiprocessing.cpu_count(),
+                        help='number of processes that check the files [default: number of CPUs]')
+    parser.add_argument('-p', '--pattern', dest='pattern', action="store",
+                        type=str, default='*.tmp',
+                        help='pattern of the tmp-file names [default: *.tmp]')
+    parser.add_argument('--no-index', dest='use_index', action="store_false",
+                        help='do not use the index files of the tmp-files')
+    parser.add_argument('--write-index', dest='write_index', action="store_true",
+                        help='write the index files of tmp-files that have none')
+    parser.add_argument('--json', dest='json', action="store",
+                        type=str, default=None,
+                        help='JSON file for the results of all files')
+    parser.add_argument('-q', '--quiet', dest='quiet', action="store_true",
+                        help='only print the totals')
+    args = parser.parse_args(argv)
+
+    files = find_tmp_files(args.paths, args.pattern)
+    sys.stdout.write('Checking %i files ...\n' % (len(files)))
+    results = []
+    for result in validate(files, workers=args.workers, use_index=args.use_index,
+                           write_index=args.write_index):
+        results.append(result)
+        if not args.quiet:
+            sys.stdout.write(format_result(result))
+    totals = get_totals(results)
+    sys.stdout.write('%s\n' % ', '.join(['%s: %i' % item for item in totals.items()]))
+    if args.json:
+        f = open(args.json, 'w')
+        try:
+            json.dump(collections.OrderedDict([('totals', totals), ('files', results)]), f, indent=2)
+            f.write('\n')
+        finally:
+            f.close()
+        sys.stdout.write('Results written to ... %s\n' % (args.json))
+    return 1 if totals['errors'] else 0
+
 
-Validator(wxrx_file)
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,13 +5,17 @@ Created on 5 Jan 2012
 '''
 
 import datetime
+import hashlib
 import netCDF4
 import numpy as np
 import os
 import re
-import scipy.interpolate
+import sys
 
 import faam_wxrx
+from faam_wxrx.nav import NAV_VARIABLES, read_core_nav, interp_nav
+from faam_wxrx.profiling import hot_path
+from faam_wxrx.utils import get_sweep_index, get_time_index
 
 #Variable definition
 #long_name, description,
@@ -82,12 +86,77 @@ control_accept:description = 0: Do not accept control,
 1: IND 1 accept control,
 2: IND 2 accept control,
 3: All INDs accept control;
-slave:units = None;"""
+slave:units = None;
+sweep_start:long_name = Index of the first record of the antenna sweep;
+sweep_end:long_name = Index after the last record of the antenna sweep;
+sweep_time:long_name = Time of the first record of the antenna sweep;
+time_index:long_name = Index of the first record at or after every full second;
+time_index:description = Entry k belongs to the second start_time+k (see attribute start_time). The last entry is the number of records;"""
+
+# Storage settings for the netCDF variables. The (time, bin) variables are
+# chunked by 'chunk_time' records, which is about one antenna sweep, and all
+# 512 bins; the time series are chunked by 'chunk_time_1d' records.
+# least_significant_digit maps variable names to the number of decimals that
+# are kept (lossy compression), which is only meant for the navigation data.
+STORAGE_PROFILES = {'default': {'chunk_time': 1024,
+                                'chunk_time_1d': 16384,
+                                'zlib': True,
+                                'complevel': 4,
+                                'shuffle': True,
+                                'least_significant_digit': {}},
+                    'fast': {'chunk_time': 1024,
+                             'chunk_time_1d': 16384,
+                             'zlib': True,
+                             'complevel': 1,
+                             'shuffle': True,
+                             'least_significant_digit': {}},
+                    'compact': {'chunk_time': 1024,
+                                'chunk_time_1d': 16384,
+                                'zlib': True,
+                                'complevel': 6,
+                                'shuffle': True,
+                                'least_significant_digit': {'lat_gin': 5,
+                                                            'lon_gin': 5,
+                                                            'alt_gin': 1,
+                                                            'hdg_gin': 2,
+                                                            'ptch_gin': 2}},
+                    'none': {'chunk_time': None,
+                             'chunk_time_1d': None,
+                             'zlib': False,
+                             'complevel': 0,
+                             'shuffle': False,
+                             'least_significant_digit': {}}}
+
+
+def get_storage_options(storage_profile, var_name, dimensions):
+    """Returns the keyword arguments for netCDF4.Dataset.createVariable
+    for a single variable. storage_profile is either the name of one of
+    the STORAGE_PROFILES or a dictionary with the same keys.
+
+    """
+    if not isinstance(storage_profile, dict):
+        storage_profile = STORAGE_PROFILES[storage_profile]
+    if 'time' not in dimensions:
+        return {}
+    result = {'zlib': storage_profile['zlib'],
+              'complevel': storage_profile['complevel'],
+              'shuffle': storage_profile['shuffle']}
+    if 'bin' in dimensions and storage_profile['chunk_time']:
+        result['chunksizes'] = (storage_profile['chunk_time'], 512)
+    elif 'bin' not in dimensions and storage_profile['chunk_time_1d']:
+        result['chunksizes'] = (storage_profile['chunk_time_1d'],)
+    if var_name in storage_profile['least_significant_digit']:
+        result['least_significant_digit'] = storage_profile['least_significant_digit'][var_name]
+    return result
 
 
 class Setup(object):
 
-    def __init__(self, ncfilename):
+    def __init__(self, ncfilename, storage_profile='default'):
+        """Creates the empty weather radar netCDF. storage_profile sets the
+        chunking and compression of the variables (see STORAGE_PROFILES).
+
+        """
         self.ncfilename = ncfilename
         self.ds = netCDF4.Dataset(self.ncfilename, 'w', format='NETCDF4')
 
@@ -107,15 +176,16 @@ class Setup(object):
         # dimensions
         self.ds.createDimension('time', None)
         self.ds.createDimension('bin', 512)
+        self.ds.createDimension('sweep', None)
+        self.ds.createDimension('index_second', None)
 
-        self.ds.variables['bin'] = np.array(range(512))
         #WXRX_VARS_DESCRIPTION =
-        WXRX_VARS = list(set(zip(*[v.split(':') for v in (re.sub('\n', '', WXRX_VARS_DESCRIPTION)).split(';')])[0]))
+        WXRX_VARS = list(set(list(zip(*[v.split(':') for v in (re.sub('\n', '', WXRX_VARS_DESCRIPTION)).split(';')]))[0]))
         WXRX_VARS = [w.strip() for w in WXRX_VARS]
         WXRX_ATTR = [v.split(':') for v in (re.sub('\n', '', WXRX_VARS_DESCRIPTION)).split(';')]
 
         variables = [('time', 'f8', ('time')),
-                     ('bin', 'i2', ('time')),
+                     ('bin', 'i2', ('bin')),
                      ('reflectivity', 'byte', ('time', 'bin')),
                      ('operating_mode', 'byte', ('time')),
                      ('mode_annunciation', 'byte', ('time')),
@@ -132,10 +202,15 @@ class Setup(object):
                      ('faults', 'byte', ('time')),
                      ('stabilization', 'byte', ('time')),
                      ('control_accept', 'byte', ('time')),
-                     ('slave', 'byte', ('time'))]
+                     ('slave', 'byte', ('time')),
+                     ('sweep_start', 'i4', ('sweep')),
+                     ('sweep_end', 'i4', ('sweep')),
+                     ('sweep_time', 'f8', ('sweep')),
+                     ('time_index', 'i4', ('index_second'))]
 
         for v in variables:
-            tmp = self.ds.createVariable(v[0], v[1], v[2])
+            tmp = self.ds.createVariable(v[0], v[1], v[2],
+                                         **get_storage_options(storage_profile, v[0], v[2]))
             for a in WXRX_ATTR:
                 if a[0] == v[0]:
                     attrname, attrval = a[1].split('=')
@@ -143,92 +218,203 @@ class Setup(object):
                     attrval = attrval.strip()
                     tmp.setncattr(attrname, attrval)
 
+        self.ds.variables['bin'][:] = np.arange(512)
         self.ds.sync()
         tmp = None
 
+    def close(self):
+        self.ds.close()
+
+
+# pairs of (description, variable name) for all variables that are taken
+# from the decoded ARINC708 records
+RECORD_VARIABLES = [('Reflectivity', 'reflectivity'),
+                    ('Control Accept', 'control_accept'),
+                    ('Slave', 'slave'),
+                    ('Mode Annunciation', 'mode_annunciation'),
+                    ('Faults', 'faults'),
+                    ('Stabilization', 'stabilization'),
+                    ('Operating Mode', 'operating_mode'),
+                    ('Tilt', 'tilt'),
+                    ('Gain', 'gain'),
+                    ('Range', 'range'),
+                    ('Data Accept', 'data_accept'),
+                    ('Scan Angle', 'scan_angle')]
+
+
+class RecordBlock(object):
+    """Consecutive records of a single tmp-file in the form that
+    Writer.append needs: the decoded Records, their bit offsets
+    (sIndexList), their Timestamp (days since midnight, see
+    utils.add_timestamp) and the Base_time of the log.
+
+    """
+
+    def __init__(self, filename, sIndexList=None, records=None, timestamp=None, base_time=None):
+        self.Filename = filename
+        self.sIndexList = sIndexList
+        self.Records = records
+        self.Timestamp = timestamp
+        self.Base_time = base_time
+
 
 class Writer(object):
+    """Writes the decoded weather radar data to the netCDF that was created
+    by Setup.
+
+    The data of every tmp-file can either be passed in as a list and
+    written all at once (write) or appended one after the other as soon as
+    they are available (append). Appending only needs to keep a single file
+    in memory.
 
-    def __init__(self, ncfile, wxrx_data_list):
+    """
+
+    def __init__(self, ncfile, wxrx_data_list=None):
         self.ncfile = ncfile
+        if wxrx_data_list is None:
+            wxrx_data_list = []
         self.wxrx_data_list = wxrx_data_list
+        self.Inputfiles = []
         # open netCDF file in append mode
         self.ds = netCDF4.Dataset(ncfile, 'a', format='NETCDF4')
+        # index of the next record along the time dimension
+        self.n = len(self.ds.dimensions['time'])
 
+    @hot_path('Writer.close')
     def close(self):
 
+        time = self.ds.variables['time'][:]
+        if len(time) == 0:
+            self.ds.close()
+            return
+        self.__write_sweep_index__(time)
+        self.__write_time_index__(time)
         self.ds.sync()
-        stimestamp = (netCDF4.num2date(self.ds.variables['time'][:].min(), self.ds.variables['time'].units)).strftime('%Y-%m-%d %H:%M:%SUTC')
-        etimestamp = (netCDF4.num2date(self.ds.variables['time'][:].max(), self.ds.variables['time'].units)).strftime('%Y-%m-%d %H:%M:%SUTC')
+        stimestamp = (netCDF4.num2date(time.min(), self.ds.variables['time'].units)).strftime('%Y-%m-%d %H:%M:%SUTC')
+        etimestamp = (netCDF4.num2date(time.max(), self.ds.variables['time'].units)).strftime('%Y-%m-%d %H:%M:%SUTC')
         self.ds.time_interval = '%s - %s' % (stimestamp, etimestamp)
         self.ds.close()
 
-    def __write_global_attributes__(self):
+    def __write_global_attributes__(self, base_time):
         self.ds.summary = "Data from the Honeywell RDR-4B doppler weather radar."
         self.ds.creation_date = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%SUTC')
-        self.ds.inputfiles = "Inputfiles: %s" % '; '.join([os.path.basename(i) for i in self.wxrs_data_list])
         self.ds.softwareVersion = 'Processed with Version %s' % faam_wxrx.__version__
-        self.ds.variables['time'].units = self.wxrx_data_list[0].Base_time.strftime('seconds since %Y-%m-%d 00:00:00 UTC')
+        self.ds.variables['time'].units = base_time.strftime('seconds since %Y-%m-%d 00:00:00 UTC')
         self.ds.sync()
         return
 
-    def __write_variable__(self, var_name):
+    def __write_sweep_index__(self, time):
+        """Stores the first and last+1 record index of every antenna sweep,
+        so that a single sweep can be read with one slice.
 
-        dummy = None
-        for wxrx_data in self.wxrx_data_list:
-            if (dummy is None):
-                dummy = wxrx_data.Records[var_name]
-            else:
-                dummy = np.concatenate((dummy, wxrx_data.Records[var_name]))
-        self.ds.variables[var_name][:] = dummy[self.good_index]
+        """
+        if 'sweep_start' not in self.ds.variables:
+            return
+        start, end = get_sweep_index(self.ds.variables['scan_angle'][:], time=time)
+        self.ds.variables['sweep_start'][:] = start
+        self.ds.variables['sweep_end'][:] = end
+        self.ds.variables['sweep_time'][:] = time[start]
+        self.ds.variables['sweep_time'].units = self.ds.variables['time'].units
         return
 
-    def write(self):
+    def __write_time_index__(self, time):
+        """Stores the index of the first record of every second, which
+        allows to look up time windows without reading the time variable
+        (see utils.get_record_slice).
+
         """
-        Write the wxrx data to netcdf file.
+        if 'time_index' not in self.ds.variables:
+            return
+        start, index = get_time_index(time)
+        self.ds.variables['time_index'][:] = index
+        self.ds.variables['time_index'].start_time = start
+        return
+
+    @hot_path('Writer.append')
+    def append(self, wxrx_data):
+        """Appends the records of a single tmp-file along the time dimension.
+        Records without a valid timestamp are dropped.
+
         """
-        self.__write_global_attributes__()
+        if not self.Inputfiles:
+            self.__write_global_attributes__(wxrx_data.Base_time)
+        # the records of a single file may be appended in several parts
+        if os.path.basename(wxrx_data.Filename) not in self.Inputfiles:
+            self.Inputfiles.append(os.path.basename(wxrx_data.Filename))
+            self.ds.inputfiles = "Inputfiles: %s" % '; '.join(self.Inputfiles)
 
-        bin_val = self.ds.variables['bin']
-        bin_val[:] = range(512)
+        time_stamp = np.asarray(wxrx_data.Timestamp) * 86400.
+        good_index = np.where(time_stamp > 0)[0]
+        n, m = self.n, len(good_index)
+        self.ds.variables['time'][n:n+m] = time_stamp[good_index]
+        for p in RECORD_VARIABLES:
+            self.ds.variables[p[1]][n:n+m] = wxrx_data.Records[p[1]][good_index]
+        self.n += m
+        self.ds.sync()
+        return
 
+    @hot_path('Writer.write')
+    def write(self):
+        """
+        Write the wxrx data to netcdf file.
+        """
         for wxrx_data in self.wxrx_data_list:
-            time_stamp = [tmp * 86400. for tmp in wxrx_data.Timestamp]
-
-        self.good_index = list(np.where(np.array(time_stamp) > 0)[0])
-        self.ds.variables['time'][:] = np.array(time_stamp)[self.good_index]
-
-        pairs = [('Reflectivity', 'reflectivity'),
-                 ('Control Accept', 'control_accept'),
-                 ('Slave', 'slave'),
-                 ('Mode Annunciation', 'mode_annunciation'),
-                 ('Faults', 'faults'),
-                 ('Stabilization', 'stabilization'),
-                 ('Operating Mode', 'operating_mode'),
-                 ('Tilt', 'tilt'),
-                 ('Gain', 'gain'),
-                 ('Range', 'range'),
-                 ('Data Accept', 'data_accept'),
-                 ('Scan Angle', 'scan_angle')]
-
-        for p in pairs:
-            sys.stdout.write('  Writing variable  ... %s\n' % (p[1]))
-            self.__write_variable__(p[1])
+            sys.stdout.write('  Writing data from ... %s\n' % (os.path.basename(wxrx_data.Filename)))
+            self.append(wxrx_data)
         return
 
-    def merge_core_file(self, core_file):
-        core_ds = netCDF4.Dataset(core_file, 'r', format='NETCDF4')
-        time_array = self.ds.variables['time']
+    @hot_path('Writer.merge_core_file')
+    def merge_core_file(self, core_file, chunk_size=2**16, cache=None):
+        """Adds the GIN navigation from the core file at the time of every
+        record (see nav.py). Only the part of the core file that covers the
+        records is read and the result is written in chunks of chunk_size
+        records.
 
-        pairs = [('hdg_gin',  'HDG_GIN'),
-                 ('lon_gin',  'LON_GIN'),
-                 ('lat_gin',  'LAT_GIN'),
-                 ('alt_gin',  'ALT_GIN'),
-                 ('ptch_gin', 'PTCH_GIN')]
+        With a NavCache (see cache.py) the navigation is taken from the
+        cache, if the same core file has been merged with the same record
+        times before, and added to it otherwise. The key of the cache entry
+        is stored in the global attribute nav_cache_key. The plots read the
+        navigation from the netCDF itself, as the cache entry is not
+        updated if the netCDF is merged or edited again.
 
-        for p in pairs:
-            tck = scipy.interpolate.splrep(core_ds.variables['Time'][:].ravel(), core_ds.variables[p[1]][:,0].ravel())
-            self.ds.variables[p[0]][:] = scipy.interpolate.splev(time_array, tck)
+        """
+        time_var = self.ds.variables['time']
+        n = len(time_var)
+        if n == 0:
+            return
+        t_start, t_end = np.inf, -np.inf
+        time_hash = hashlib.sha1(str(getattr(time_var, 'units', '')).encode('utf-8'))
+        for i in range(0, n, chunk_size):
+            time = np.ma.filled(np.ma.asarray(time_var[i:i+chunk_size], dtype=float), np.nan)
+            t_start, t_end = np.nanmin(np.append(time, t_start)), np.nanmax(np.append(time, t_end))
+            time_hash.update(time.tobytes())
+
+        key, cached, merged = None, None, None
+        if cache:
+            key = cache.get_key(core_file, time_hash.hexdigest())
+            cached = cache.load(key)
+        if cached is None:
+            core_time, core_values = read_core_nav(core_file, t_start, t_end,
+                                                   time_units=getattr(time_var, 'units', None))
+            if cache:
+                merged = dict([(p[0], np.zeros(n, dtype=np.float32)) for p in NAV_VARIABLES])
 
-        core_ds.close()
+        for i in range(0, n, chunk_size):
+            if cached is not None:
+                nav = np.column_stack([cached[p[0]][i:i+chunk_size] for p in NAV_VARIABLES])
+            else:
+                time = np.ma.filled(np.ma.asarray(time_var[i:i+chunk_size], dtype=float), np.nan)
+                nav = interp_nav(core_time, core_values, time)
+            for j, p in enumerate(NAV_VARIABLES):
+                # records without navigation are written as fill values
+                self.ds.variables[p[0]][i:i+len(nav)] = np.ma.masked_invalid(nav[:, j])
+                if merged is not None:
+                    merged[p[0]][i:i+len(nav)] = nav[:, j]
+        if merged is not None:
+            cache.store(key, merged)
+        if key:
+            self.ds.nav_cache_key = key
+        elif 'nav_cache_key' in self.ds.ncattrs():
+            self.ds.delncattr('nav_cache_key')
+        self.ds.sync()
         return
@@ -0,0 +1,10 @@
+"""
+Benchmarks for the FAAM weather radar processing.
+
+The benchmarks do not need any flight data. They work on synthetic data
+(see synthetic.py) and can be run as scripts, e.g.
+
+    python -m faam_wxrx.benchmarks.storage
+    python -m faam_wxrx.benchmarks.throughput
+
+"""
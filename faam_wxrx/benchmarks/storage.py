@@ -0,0 +1,79 @@
+"""
+Write/read trade-off of the netCDF storage profiles (see
+faam_wxrx.Writer.STORAGE_PROFILES).
+
+For every profile a netCDF with synthetic records is written and then read
+back, once completely and once as a short time window as it is done by the
+Scan plot.
+
+"""
+
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+from faam_wxrx.Writer import Setup, Writer, RecordBlock, STORAGE_PROFILES
+from faam_wxrx.benchmarks.synthetic import make_records, SWEEP_LENGTH
+
+
+def run(n=200000, profiles=None, outpath=None):
+    """Writes and reads n synthetic records with every storage profile and
+    returns a list of dictionaries with the results.
+
+    """
+    if profiles is None:
+        profiles = sorted(STORAGE_PROFILES.keys())
+    tmpdir = tempfile.mkdtemp(dir=outpath)
+    records, timestamp = make_records(n)
+    result = []
+    try:
+        for profile in profiles:
+            ncfile = os.path.join(tmpdir, 'wxrx_%s.nc' % profile)
+
+            def write():
+                Setup(ncfile, storage_profile=profile).close()
+                writer = Writer(ncfile)
+                writer.append(RecordBlock('synthetic.tmp', records=records, timestamp=timestamp,
+                                          base_time=datetime.datetime(2012, 1, 1)))
+                writer.close()
+
+            def read_all():
+                import netCDF4
+                ds = netCDF4.Dataset(ncfile, 'r')
+                ds.variables['reflectivity'][:]
+                ds.close()
+
+            def read_window():
+                import netCDF4
+                ds = netCDF4.Dataset(ncfile, 'r')
+                ds.variables['reflectivity'][n // 2:n // 2 + SWEEP_LENGTH]
+                ds.variables['scan_angle'][n // 2:n // 2 + SWEEP_LENGTH]
+                ds.close()
+
+            write_time = timeit.timeit(write, number=1)
+            result.append({'profile': profile,
+                           'records': n,
+                           'write_s': write_time,
+                           'size_mb': os.stat(ncfile).st_size / 1024.**2,
+                           'read_all_s': timeit.timeit(read_all, number=1),
+                           'read_window_s': min(timeit.repeat(read_window, number=1, repeat=5))})
+    finally:
+        shutil.rmtree(tmpdir)
+    return result
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', dest='n', action="store", type=int, default=200000,
+                        help='number of records [default: 200000]')
+    parser.add_argument('-p', '--profile', dest='profiles', action="append",
+                        choices=sorted(STORAGE_PROFILES.keys()),
+                        help='storage profile to test; can be given more than once [default: all]')
+    args = parser.parse_args()
+    sys.stdout.write('%-10s %10s %10s %10s %12s %14s\n' % ('profile', 'records', 'write (s)', 'size (MB)', 'read all (s)', 'read sweep (s)'))
+    for r in run(args.n, args.profiles):
+        sys.stdout.write('%-10s %10i %10.2f %10.1f %12.2f %14.4f\n' % (r['profile'], r['records'], r['write_s'], r['size_mb'], r['read_all_s'], r['read_window_s']))
@@ -0,0 +1,298 @@
+"""
+Synthetic weather radar flights for the benchmarks.
+
+The data look like the output of the CoPilot software: ARINC708 buswords
+with the label '550', a 144 bit gap after every busword and the bits of
+every byte in reverse order (see Arinc708.__rearrange_bits__). The antenna
+sweeps between 280 and 80 degrees and there are a few rain cells, so that
+most gates are 0 like in real data. Junk bits are inserted every now and
+then, after which the buswords no longer start at a byte boundary.
+
+A flight consists of the tmp-files, the matching filesize log (see
+filesizeLogger.pyw) and a minimal core netCDF with the GIN navigation, so
+that it can be processed like a real flight, e.g.
+
+    python -m faam_wxrx.benchmarks.synthetic /tmp/b999 -n 200000
+    python -m faam_wxrx.processing /tmp/b999 /tmp/b999/core_faam_20120102_v004_r0_b999.nc
+
+Note that the processing skips tmp-files with less than about 11400
+records (see utils.get_wxrx_tmp_filelist).
+
+"""
+
+import datetime
+import os
+import sys
+import numpy as np
+
+from faam_wxrx.Arinc708 import _REC, _LABEL, _RANGE_CODE
+
+# records per antenna sweep
+SWEEP_LENGTH = 1024
+# records per second that the radar sends (see Reader.__str__)
+RECORD_RATE = 190.
+# bits of a busword and the gap after it
+RECORD_LENGTH = 1744
+
+_RANGE = dict([(int(nm), code) for code, nm in enumerate(_RANGE_CODE) if nm != 9999])
+
+
+def make_records(n, seed=0, start=0):
+    """Creates n synthetic records, which are the records start to
+    start + n of a flight, so that a long flight can be created in pieces.
+
+    Returns the records and their timestamp (days since midnight).
+
+    """
+    rng = np.random.RandomState([seed, start])
+    i = start + np.arange(n)
+    records = np.zeros(n, dtype=_REC.dtype)
+    records['label'] = _LABEL
+    records['control_accept'] = 3
+    records['operating_mode'] = 1
+    records['stabilization'] = 1
+    records['range'] = 80
+    records['tilt'] = -2.0
+    records['data_accept'] = 3
+    phase = (i % (2 * SWEEP_LENGTH)) / float(SWEEP_LENGTH)
+    angle = -80. + 160. * np.where(phase < 1, phase, 2 - phase)
+    records['scan_angle'] = np.round(np.mod(angle, 360) / 0.087890625) % 4096 * 0.087890625
+    gates = np.arange(512)
+    for k in range(max(n // 2000, 1)):
+        centre_angle, centre_bin = rng.uniform(-80, 80), rng.uniform(50, 450)
+        size_angle, size_bin = rng.uniform(2, 15), rng.uniform(5, 40)
+        dist = ((angle[:, np.newaxis] - centre_angle) / size_angle)**2 + \
+               ((gates[np.newaxis, :] - centre_bin) / size_bin)**2
+        cell = np.clip(4 - np.floor(dist * 4), 0, 4).astype(np.byte)
+        records['reflectivity'] = np.maximum(records['reflectivity'], cell)
+    timestamp = (36000. + i / RECORD_RATE) / 86400.
+    return records, timestamp
+
+
+def _put_bits_(bits, start, width, values, base=2):
+    """Writes the values into the bit columns start to start + width,
+    lowest digit first.
+
+    """
+    values = np.asarray(values).astype(np.int64)
+    bits[:, start:start+width] = (values[:, np.newaxis] // base ** np.arange(width)) % base
+
+
+def encode_records(records):
+    """Encodes the records as buswords; the inverse of Arinc708.parse_many.
+
+    Returns an array of shape (n, 200) with the bytes of every busword as
+    they are stored in a tmp-file. The stabilization is the lowest bit of
+    the operating mode and is not encoded separately. mode_annunciation,
+    faults and gain are read as decimal numbers of their bits (see
+    Arinc708.__get_faults__), so only values with the digits 0 and 1 can be
+    encoded.
+
+    """
+    n = len(records)
+    bits = np.zeros((n, 1600), dtype=np.uint8)
+    # the label is read from the file bits, before they are reversed
+    label = np.array([int(l, 8) if l else 0 for l in records['label']], dtype=np.int64)
+    _put_bits_(bits, 0, 8, label >> 1)
+    bits[:, 15] = label & 1
+    _put_bits_(bits, 8, 2, records['control_accept'])
+    bits[:, 11] = records['slave']
+    _put_bits_(bits, 13, 5, records['mode_annunciation'], base=10)
+    _put_bits_(bits, 18, 7, records['faults'], base=10)
+    _put_bits_(bits, 26, 3, records['operating_mode'])
+    negative = records['tilt'] < 0
+    bits[:, 35] = negative
+    _put_bits_(bits, 29, 6, np.round((records['tilt'] + 16 * negative) / 0.25))
+    _put_bits_(bits, 36, 6, records['gain'], base=10)
+    _put_bits_(bits, 42, 6, [_RANGE.get(int(r), 0) for r in records['range']])
+    _put_bits_(bits, 49, 2, records['data_accept'])
+    _put_bits_(bits, 51, 12, np.round(records['scan_angle'] / 0.087890625) % 4096)
+    gates = records['reflectivity'].astype(np.int64) & 7
+    bits[:, 64:] = ((gates[:, :, np.newaxis] >> np.arange(3)) & 1).reshape(n, 1536)
+    # every byte is stored with its bits in reverse order
+    return np.packbits(bits.reshape(n, 200, 8)[:, :, ::-1], axis=2).reshape(n, 200)
+
+
+def make_tmp_file(filename, n, seed=0, junk_prob=0.001, noise=False, chunk_size=4096):
+    """Writes a synthetic tmp-file with n records. After a record, junk of 1
+    to 3000 bits is inserted with the probability junk_prob, which moves the
+    following records off the byte boundaries. The junk is an idle bus
+    (zeros) or, with noise, random bits; random bits contain false '550'
+    labels, so that the Reader finds some records that were never written.
+
+    The file is written in chunks of chunk_size records, so that the memory
+    does not depend on n. Returns the bit offsets of the records.
+
+    """
+    rng = np.random.RandomState(seed)
+    offsets = np.zeros(n, dtype=np.int64)
+    # bits that did not fill a complete byte yet
+    carry = np.zeros(0, dtype=np.uint8)
+    position = 0
+    f = open(filename, 'wb')
+    try:
+        for i in range(0, n, chunk_size):
+            records = make_records(min(chunk_size, n - i), seed=seed, start=i)[0]
+            m = len(records)
+            bits = np.zeros((m, RECORD_LENGTH), dtype=np.uint8)
+            bits[:, :1600] = np.unpackbits(encode_records(records), axis=1)
+            junk = np.where(rng.random_sample(m) < junk_prob, rng.randint(1, 3000, m), 0)
+            lengths = RECORD_LENGTH + junk
+            offsets[i:i+m] = position + np.cumsum(lengths) - lengths
+            position += int(np.sum(lengths))
+            pieces, k = [carry], 0
+            for j in np.where(junk > 0)[0]:
+                pieces.append(bits[k:j+1].ravel())
+                if noise:
+                    pieces.append(rng.randint(0, 2, junk[j]).astype(np.uint8))
+                else:
+                    pieces.append(np.zeros(junk[j], dtype=np.uint8))
+                k = j + 1
+            pieces.append(bits[k:].ravel())
+            stream = np.concatenate(pieces)
+            nbytes = len(stream) // 8
+            np.packbits(stream[:nbytes * 8]).tofile(f)
+            carry = stream[nbytes * 8:]
+        if len(carry):
+            np.packbits(carry).tofile(f)
+    finally:
+        f.close()
+    return offsets
+
+
+def make_log(filename, files, start_time, interval=10., pause=30.):
+    """Writes a filesize log for the tmp-files, as the filesizeLogger does
+    every interval seconds while CoPilot writes them one after the other.
+
+    files is a list of (tmp-file, bit offsets of the records) and the first
+    record is written at start_time. There is a pause of pause seconds
+    between two files. Returns the time (seconds since midnight) of the
+    first and last record.
+
+    """
+    midnight = datetime.datetime.combine(start_time.date(), datetime.time())
+    t0 = (start_time - midnight).total_seconds()
+    lines = ['#' * 45,
+             '#  Logging started: ' + start_time.strftime('%Y-%m-%d %H:%M:%S.%f'),
+             '#' * 45]
+    t_file = t0
+    for tmp_file, offsets in files:
+        file_size = os.path.getsize(tmp_file)
+        duration = len(offsets) / RECORD_RATE
+        t = (np.floor(t_file / interval) + 1) * interval
+        while True:
+            # number of records written until t
+            k = int(min(max((t - t_file) * RECORD_RATE, 0), len(offsets)))
+            size = file_size if k == len(offsets) else (int(offsets[k]) + 7) // 8
+            stamp = midnight + datetime.timedelta(seconds=t)
+            lines.append('%s,%i,%s' % (stamp.strftime('%Y-%m-%d %H:%M:%S'), size, os.path.basename(tmp_file)))
+            if k == len(offsets):
+                break
+            t += interval
+        t_file += duration + pause
+    f = open(filename, 'w')
+    try:
+        f.write('\n'.join(lines) + '\n')
+    finally:
+        f.close()
+    return t0, t_file - pause
+
+
+def make_core(filename, t_start, t_end, date, seed=0):
+    """Writes a minimal core netCDF with the GIN navigation (32Hz) between
+    t_start and t_end (seconds since midnight of date). The aircraft flies
+    straight legs of 5 minutes at 120 m/s and turns between them.
+
+    """
+    import netCDF4
+    rng = np.random.RandomState(seed)
+    time = np.arange(int(np.floor(t_start)), int(np.ceil(t_end)) + 1)
+    t = (time[:, np.newaxis] + np.arange(32) / 32.).ravel()
+    leg = ((t - t[0]) // 300).astype(int)
+    heading = np.mod(rng.uniform(0, 360, leg.max() + 1)[leg], 360)
+    # turn at 3 deg/s into the heading of the next leg
+    dt = 1 / 32.
+    hdg = np.zeros(len(t))
+    hdg[0] = heading[0]
+    diff = np.zeros(len(t))
+    for i in range(1, len(t)):
+        diff[i] = (heading[i] - hdg[i-1] + 180.) % 360. - 180.
+        hdg[i] = (hdg[i-1] + np.clip(diff[i], -3 * dt, 3 * dt)) % 360.
+    north = np.cumsum(120. * dt * np.cos(np.deg2rad(hdg)))
+    east = np.cumsum(120. * dt * np.sin(np.deg2rad(hdg)))
+    lat = 52. + north / 111200.
+    lon = -1. + east / (111200. * np.cos(np.deg2rad(lat)))
+    values = {'HDG_GIN': hdg,
+              'LAT_GIN': lat,
+              'LON_GIN': lon,
+              'ALT_GIN': 3000. + 20. * np.sin(t / 100.),
+              'PTCH_GIN': 2. + 0.5 * np.sin(t / 30.)}
+    ds = netCDF4.Dataset(filename, 'w')
+    try:
+        ds.createDimension('Time', None)
+        ds.createDimension('sps32', 32)
+        var = ds.createVariable('Time', 'i4', ('Time',))
+        var.units = date.strftime('seconds since %Y-%m-%d 00:00:00 +0000')
+        var[:] = time
+        for name in sorted(values.keys()):
+            var = ds.createVariable(name, 'f4', ('Time', 'sps32'), fill_value=-9999.)
+            var[:] = values[name].reshape(-1, 32)
+    finally:
+        ds.close()
+
+
+def make_flight(path, n, files=2, fid='b999', date=datetime.date(2012, 1, 2), seed=0,
+                junk_prob=0.001, noise=False):
+    """Creates a synthetic flight with n records, split up into files
+    tmp-files, in the directory path. junk_prob and noise are passed on
+    to make_tmp_file.
+
+    Returns a dictionary with the paths of the tmp-files (tmp_files), the
+    log (log_file) and the core netCDF (core_file) and the flight number
+    (fid).
+
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    counts = np.diff(np.linspace(0, n, files + 1).astype(int))
+    tmp_files = []
+    for i, count in enumerate(counts):
+        tmp_file = os.path.join(path, 'COP%i.tmp' % (i + 1))
+        offsets = make_tmp_file(tmp_file, count, seed=seed + i, junk_prob=junk_prob, noise=noise)
+        tmp_files.append((tmp_file, offsets))
+    log_file = os.path.join(path, fid + '.log')
+    start_time = datetime.datetime.combine(date, datetime.time(10, 11, 12, 123456))
+    t_start, t_end = make_log(log_file, tmp_files, start_time)
+    core_file = os.path.join(path, 'core_faam_%s_v004_r0_%s.nc' % (date.strftime('%Y%m%d'), fid))
+    # the core data cover the flight with a few minutes on both sides
+    make_core(core_file, t_start - 300, t_end + 300, date, seed=seed)
+    return {'fid': fid,
+            'tmp_files': [f[0] for f in tmp_files],
+            'log_file': log_file,
+            'core_file': core_file}
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', action="store", type=str,
+                        help='output directory')
+    parser.add_argument('-n', dest='n', action="store", type=int, default=200000,
+                        help='number of records [default: 200000]')
+    parser.add_argument('-f', '--files', dest='files', action="store", type=int, default=2,
+                        help='number of tmp-files [default: 2]')
+    parser.add_argument('--fid', dest='fid', action="store", type=str, default='b999',
+                        help='flight number [default: b999]')
+    parser.add_argument('--junk', dest='junk_prob', action="store", type=float, default=0.001,
+                        help='probability of junk bits after a record [default: 0.001]')
+    parser.add_argument('--noise', dest='noise', action="store_true",
+                        help='random instead of idle junk bits')
+    parser.add_argument('--seed', dest='seed', action="store", type=int, default=0,
+                        help='seed of the random numbers [default: 0]')
+    args = parser.parse_args()
+    flight = make_flight(args.path, args.n, files=args.files, fid=args.fid,
+                         seed=args.seed, junk_prob=args.junk_prob, noise=args.noise)
+    for tmp_file in flight['tmp_files']:
+        sys.stdout.write('%s\n' % tmp_file)
+    sys.stdout.write('%s\n%s\n' % (flight['log_file'], flight['core_file']))
@@ -0,0 +1,423 @@
+"""
+Throughput and memory of the processing steps on synthetic flights (see
+synthetic.py).
+
+For every size a flight is created and every step is run on it in a fresh
+Python process, so that the memory of one step does not include the memory
+of the steps before. The input of a step (e.g. the decoded records for
+Writer.write) is prepared in the same process before the step is timed.
+
+The steps are named after the hot paths (see profiling.py):
+
+  Reader.parse         find the record positions (without index)
+  Arinc708.parse       decode single buswords with bitstring (a sample of
+                       SAMPLE_SIZE records only)
+  Arinc708.parse_many  decode all records (parse_file)
+  Arinc708.parse_headers
+                       decode the headers of all records
+                       (parse_headers_file)
+  add_timestamp        timestamp all records from the filesize log
+  Writer.write         write the records to a new netCDF and close it
+  merge_core_file      add the GIN navigation from the core netCDF
+  Overview             create the overview plot
+  Scan                 plot SCAN_COUNT sweeps spread over the flight
+
+For every step the records/s, MB/s (of the tmp-file data), the memory
+after the preparation and the peak memory while the step runs are
+reported. The peak is sampled in a background thread (see
+progress.get_rss), so it does not include the imports and the
+preparation.
+
+The results can be written to a JSON file together with the versions of
+the software, so that runs on different machines and releases can be
+compared, e.g.
+
+    python -m faam_wxrx.benchmarks.throughput -n 20000 -n 200000 -o bench.json
+
+"""
+
+import collections
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+import faam_wxrx
+from faam_wxrx.Arinc708 import Arinc708, parse_file, parse_headers_file, DECODER_VERSION
+from faam_wxrx.Reader import Reader
+from faam_wxrx.Writer import Setup, Writer
+from faam_wxrx.pipeline import Block
+from faam_wxrx.progress import get_rss
+from faam_wxrx.utils import FilesizeLog, add_timestamp
+from faam_wxrx.benchmarks.synthetic import make_flight
+
+STEPS = ('Reader.parse', 'Arinc708.parse', 'Arinc708.parse_many', 'Arinc708.parse_headers',
+         'add_timestamp', 'Writer.write', 'merge_core_file', 'Overview', 'Scan')
+# steps that need the netCDF of the flight
+_NETCDF_STEPS = ('merge_core_file', 'Overview', 'Scan')
+
+SIZES = (20000, 200000)
+# records that are decoded by Arinc708.parse
+SAMPLE_SIZE = 2000
+# sweeps that are plotted by Scan
+SCAN_COUNT = 5
+# seconds between two samples of the memory while a step runs
+_RSS_INTERVAL = 0.005
+
+
+class _RssSampler(object):
+    """Context manager that samples the memory of the process (see
+    progress.get_rss) in a background thread and keeps the highest value.
+
+    """
+
+    def __init__(self, interval=_RSS_INTERVAL):
+        self.Interval = interval
+        self.Peak = get_rss() or 0
+        self.Stop = threading.Event()
+        self.Thread = threading.Thread(target=self.__sample__)
+        self.Thread.daemon = True
+
+    def __sample__(self):
+        while not self.Stop.wait(self.Interval):
+            self.Peak = max(self.Peak, get_rss() or 0)
+
+    def __enter__(self):
+        self.Thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.Stop.set()
+        self.Thread.join()
+        self.Peak = max(self.Peak, get_rss() or 0)
+
+
+def _get_nbytes_(flight):
+    return sum([os.path.getsize(f) for f in flight['tmp_files']])
+
+
+def _read_(flight):
+    result = []
+    for tmp_file in flight['tmp_files']:
+        reader = Reader(tmp_file, use_mmap=True, use_index=False)
+        reader.parse()
+        result.append(reader)
+    return result
+
+
+def _get_blocks_(flight):
+    """Returns a Block with the valid and timestamped records of every
+    tmp-file, as the pipeline passes them on to Writer.append.
+
+    """
+    log = FilesizeLog(flight['log_file'])
+    result = []
+    for reader in _read_(flight):
+        block = Block(reader.Filename, np.asarray(reader.sIndexList, dtype=np.int64),
+                      reader.byte_range, last=True)
+        block.Records = parse_file(block.Filename, block.sIndexList, block.byte_range)
+        ix = np.where(block.Records['label'] == '550')[0]
+        block.sIndexList, block.Records = block.sIndexList[ix], block.Records[ix]
+        add_timestamp(block, log)
+        result.append(block)
+    return result
+
+
+def _write_netcdf_(ncfile, blocks):
+    Setup(ncfile).close()
+    writer = Writer(ncfile, blocks)
+    writer.write()
+    writer.close()
+    return writer.n
+
+
+def _reader_parse_(flight, workdir):
+    def run():
+        return sum([len(reader.sIndexList) for reader in _read_(flight)])
+    return run
+
+
+def _arinc708_parse_(flight, workdir):
+    reader = _read_(flight)[0]
+    buswords = reader.Buswords[:SAMPLE_SIZE]
+
+    def run():
+        arinc708 = Arinc708()
+        for busword in buswords:
+            arinc708.parse(busword)
+        return len(buswords)
+    return run
+
+
+def _arinc708_parse_many_(flight, workdir):
+    readers = _read_(flight)
+
+    def run():
+        return sum([len(parse_file(reader.Filename, reader.sIndexList, reader.byte_range))
+                    for reader in readers])
+    return run
+
+
+def _arinc708_parse_headers_(flight, workdir):
+    readers = _read_(flight)
+
+    def run():
+        return sum([len(parse_headers_file(reader.Filename, reader.sIndexList, reader.byte_range))
+                    for reader in readers])
+    return run
+
+
+def _add_timestamp_(flight, workdir):
+    log = FilesizeLog(flight['log_file'])
+    blocks = [Block(reader.Filename, np.asarray(reader.sIndexList, dtype=np.int64), reader.byte_range)
+              for reader in _read_(flight)]
+
+    def run():
+        for block in blocks:
+            add_timestamp(block, log)
+        return sum([len(block.sIndexList) for block in blocks])
+    return run
+
+
+def _writer_write_(flight, workdir):
+    blocks = _get_blocks_(flight)
+    ncfile = os.path.join(workdir, 'write.nc')
+
+    def run():
+        return _write_netcdf_(ncfile, blocks)
+    return run
+
+
+def _merge_core_file_(flight, workdir):
+    ncfile = os.path.join(workdir, 'merge.nc')
+    shutil.copy(flight['netcdf'], ncfile)
+    writer = Writer(ncfile)
+
+    def run():
+        writer.merge_core_file(flight['core_file'])
+        writer.ds.close()
+        return writer.n
+    return run
+
+
+def _overview_(flight, workdir):
+    from faam_wxrx.wxrx_plot_overview import Overview
+    imgfile = os.path.join(workdir, 'overview.png')
+
+    def run():
+        Overview(flight['netcdf'], imgfile)
+        return flight['records']
+    return run
+
+
+def _scan_(flight, workdir):
+    import netCDF4
+    import matplotlib.pyplot as plt
+    from faam_wxrx.wxrx_plot_scan import Scan
+    ds = netCDF4.Dataset(flight['netcdf'], 'r')
+    sweep_time = ds.variables['sweep_time'][:]
+    ds.close()
+    # whole sweeps only
+    secs = sweep_time[np.linspace(1, len(sweep_time) - 2, SCAN_COUNT).astype(int)]
+    imgfile = os.path.join(workdir, 'scan.png')
+
+    def run():
+        n = 0
+        for sec in secs:
+            scan = Scan(flight['netcdf'], sec, imgfile)
+            scan.plot()
+            scan._close_netcdf_()
+            plt.close(scan.Figure)
+            n += scan.ix_upper - scan.ix_lower
+        return n
+    return run
+
+
+_STEP_FUNCTIONS = {'Reader.parse': _reader_parse_,
+                   'Arinc708.parse': _arinc708_parse_,
+                   'Arinc708.parse_many': _arinc708_parse_many_,
+                   'Arinc708.parse_headers': _arinc708_parse_headers_,
+                   'add_timestamp': _add_timestamp_,
+                   'Writer.write': _writer_write_,
+                   'merge_core_file': _merge_core_file_,
+                   'Overview': _overview_,
+                   'Scan': _scan_}
+
+
+def run_step(step, flight, workdir):
+    """Prepares and runs a single step in this process and returns its
+    result. flight is a dictionary as returned by make_flight, which also
+    needs the netCDF (netcdf) and its number of records (records) for the
+    steps in _NETCDF_STEPS.
+
+    """
+    run = _STEP_FUNCTIONS[step](flight, workdir)
+    rss = get_rss()
+    with _RssSampler() as sampler:
+        t = time.time()
+        records = run()
+        seconds = time.time() - t
+    peak_rss = sampler.Peak
+    nbytes = _get_nbytes_(flight)
+    if step == 'Arinc708.parse':
+        # only a sample of the records
+        nbytes = records * 218
+    elif step == 'Scan':
+        nbytes = 0
+    result = collections.OrderedDict()
+    result['step'] = step
+    result['records'] = int(records)
+    result['bytes'] = nbytes
+    result['seconds'] = seconds
+    result['records_per_second'] = records / seconds if seconds > 0 else None
+    result['mb_per_second'] = nbytes / 1024.**2 / seconds if seconds > 0 and nbytes else None
+    result['rss_mb'] = rss / 1024.**2 if rss else None
+    result['peak_rss_mb'] = peak_rss / 1024.**2 if peak_rss else None
+    # memory that the step needs on top of its input
+    result['step_rss_mb'] = (peak_rss - rss) / 1024.**2 if rss and peak_rss else None
+    return result
+
+
+def _run_in_process_(step, flight_file, workdir):
+    """Runs a step in a new Python process and returns its result."""
+    output = os.path.join(workdir, 'result.json')
+    env = dict(os.environ)
+    # the package is found even if it is not installed
+    root = os.path.dirname(os.path.dirname(os.path.abspath(faam_wxrx.__file__)))
+    env['PYTHONPATH'] = os.pathsep.join([root] + [p for p in [env.get('PYTHONPATH')] if p])
+    env['MPLBACKEND'] = 'Agg'
+    cmd = [sys.executable, '-m', 'faam_wxrx.benchmarks.throughput',
+           '--step', step, '--flight', flight_file, '--output', output]
+    devnull = open(os.devnull, 'w')
+    try:
+        subprocess.check_call(cmd, env=env, stdout=devnull)
+    finally:
+        devnull.close()
+    f = open(output)
+    try:
+        return json.load(f, object_pairs_hook=collections.OrderedDict)
+    finally:
+        f.close()
+
+
+def get_info():
+    """Returns the versions of the software and the machine."""
+    import netCDF4
+    info = collections.OrderedDict()
+    info['date'] = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%SUTC')
+    info['version'] = faam_wxrx.__version__
+    info['decoder_version'] = DECODER_VERSION
+    info['python'] = platform.python_version()
+    info['numpy'] = np.__version__
+    info['netCDF4'] = netCDF4.__version__
+    info['platform'] = platform.platform()
+    info['cpus'] = multiprocessing.cpu_count()
+    return info
+
+
+def run(sizes=SIZES, steps=STEPS, files=2, repeat=1, seed=0, outpath=None):
+    """Runs the steps on synthetic flights with every number of records in
+    sizes and returns a list with the result of every step and size. With
+    repeat > 1 the fastest of repeat runs is kept.
+
+    """
+    result = []
+    for n in sizes:
+        tmpdir = tempfile.mkdtemp(dir=outpath)
+        try:
+            flight = make_flight(os.path.join(tmpdir, 'flight'), n, files=files, seed=seed)
+            if set(steps) & set(_NETCDF_STEPS):
+                flight['netcdf'] = os.path.join(tmpdir, 'flight.nc')
+                flight['records'] = _write_netcdf_(flight['netcdf'], _get_blocks_(flight))
+                writer = Writer(flight['netcdf'])
+                writer.merge_core_file(flight['core_file'])
+                writer.ds.close()
+            flight_file = os.path.join(tmpdir, 'flight.json')
+            f = open(flight_file, 'w')
+            try:
+                json.dump(flight, f)
+            finally:
+                f.close()
+            for step in steps:
+                best = None
+                for i in range(repeat):
+                    r = _run_in_process_(step, flight_file, tmpdir)
+                    if best is None or r['seconds'] < best['seconds']:
+                        best = r
+                result.append(collections.OrderedDict([('size', n)] + list(best.items())))
+        finally:
+            shutil.rmtree(tmpdir)
+    return result
+
+
+def format_results(results):
+    """Returns the results as a table with fixed columns."""
+    lines = ['%-10s %-22s %10s %10s %12s %8s %9s %9s %9s' % ('size', 'step', 'records', 'time (s)', 'records/s',
+                                                              'MB/s', 'RSS (MB)', 'peak (MB)', 'step (MB)')]
+    for r in results:
+        lines.append('%-10i %-22s %10i %10.3f %12s %8s %9.0f %9.0f %9.0f' %
+                     (r['size'], r['step'], r['records'], r['seconds'],
+                      '%.0f' % r['records_per_second'] if r['records_per_second'] else '-',
+                      '%.1f' % r['mb_per_second'] if r['mb_per_second'] else '-',
+                      r['rss_mb'] or 0, r['peak_rss_mb'] or 0, r['step_rss_mb'] or 0))
+    return '\n'.join(lines) + '\n'
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', dest='sizes', action="append", type=int,
+                        help='number of records of a flight; can be given more than once [default: %s]' %
+                             ', '.join([str(n) for n in SIZES]))
+    parser.add_argument('-s', '--step', dest='steps', action="append", choices=STEPS,
+                        help='step to run; can be given more than once [default: all]')
+    parser.add_argument('-f', '--files', dest='files', action="store", type=int, default=2,
+                        help='number of tmp-files of a flight [default: 2]')
+    parser.add_argument('-r', '--repeat', dest='repeat', action="store", type=int, default=1,
+                        help='keep the fastest of this many runs of every step [default: 1]')
+    parser.add_argument('-o', '--output', dest='output', action="store", type=str, default=None,
+                        help='JSON file for the results')
+    parser.add_argument('--tmpdir', dest='tmpdir', action="store", type=str, default=None,
+                        help='directory for the synthetic flights [default: system temp directory]')
+    # used internally to run a single step in a new process
+    parser.add_argument('--flight', dest='flight', action="store", type=str, default=None,
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.flight:
+        f = open(args.flight)
+        try:
+            flight = json.load(f)
+        finally:
+            f.close()
+        workdir = tempfile.mkdtemp(dir=os.path.dirname(args.flight))
+        try:
+            result = run_step(args.steps[0], flight, workdir)
+        finally:
+            shutil.rmtree(workdir)
+        f = open(args.output, 'w')
+        try:
+            json.dump(result, f, indent=2)
+        finally:
+            f.close()
+        sys.exit(0)
+    results = run(args.sizes or SIZES, args.steps or STEPS, files=args.files,
+                  repeat=args.repeat, outpath=args.tmpdir)
+    sys.stdout.write(format_results(results))
+    if args.output:
+        f = open(args.output, 'w')
+        try:
+            json.dump(collections.OrderedDict([('info', get_info()), ('results', results)]), f, indent=2)
+            f.write('\n')
+        finally:
+            f.close()
+        sys.stdout.write('Results written to ... %s\n' % (args.output))
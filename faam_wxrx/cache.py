@@ -0,0 +1,296 @@
+'''
+Cache for the decoded weather radar records and the merged navigation.
+
+Decoding the ARINC708 buswords is the most expensive step of the
+processing. Reprocessing a flight (new revision, corrected core file, new
+plots) does not change the records of a tmp-file, so the decoded records
+are kept as one uncompressed .npy file per column, which are memory mapped
+when they are used again. The columns are written in parts as the records
+are decoded (see ColumnWriter), so a file never has to be held in memory.
+
+Entries are addressed by the content of the tmp-file, the record positions
+and the decoder version (see Arinc708.DECODER_VERSION), so that a changed
+file or decoder never returns stale records. In the same way the GIN
+navigation at the record times (see nav.py) is addressed by the content of
+the core file, the record times and nav.NAV_VERSION. The least recently
+used entries are deleted, once the cache grows beyond its size limit.
+
+The cache directory is taken from the environment variable FAAM_WXRX_CACHE
+(default: ~/.cache/faam_wxrx) and the size limit in MB from
+FAAM_WXRX_CACHE_SIZE (default: 10240).
+
+'''
+
+import hashlib
+import io
+import os
+import shutil
+import struct
+import numpy as np
+
+from .Arinc708 import _REC, DECODER_VERSION
+from .nav import NAV_VARIABLES, NAV_VERSION
+from .profiling import hot_path
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'faam_wxrx')
+CACHE_SIZE = 10240
+
+
+@hot_path('get_file_hash')
+def get_file_hash(filename, blocksize=2**20):
+    """Returns the sha1 hex digest of the content of a file."""
+    sha1 = hashlib.sha1()
+    f = open(filename, 'rb')
+    try:
+        block = f.read(blocksize)
+        while block:
+            sha1.update(block)
+            block = f.read(blocksize)
+    finally:
+        f.close()
+    return sha1.hexdigest()
+
+
+def _get_npy_header_(dtype, shape, rows):
+    """Returns the .npy header (format version 1.0) for rows rows of the
+    given dtype and shape. The header is always as long as the one for
+    2**63-1 rows, so that it can be written again in place once more rows
+    have been added to the file.
+
+    """
+    def get_header(n):
+        f = io.BytesIO()
+        np.lib.format.write_array_header_1_0(f, {'descr': np.lib.format.dtype_to_descr(dtype),
+                                                 'fortran_order': False,
+                                                 'shape': (n,) + tuple(shape)})
+        return f.getvalue()
+    header, longest = get_header(rows), get_header(2**63 - 1)
+    # magic string, version and header length take 10 bytes; the header
+    # text is padded with spaces and ends with a newline
+    text = header[10:-1].ljust(len(longest) - 11) + b'\n'
+    return header[:8] + struct.pack('<H', len(text)) + text
+
+
+def _get_size_(path):
+    return sum([os.path.getsize(os.path.join(path, f)) for f in os.listdir(path)])
+
+
+class ColumnCache(object):
+    """Directory of cached arrays. Every entry is a directory that holds
+    one .npy file for every column.
+
+    """
+
+    def __init__(self, path=None, max_size=None):
+        if path is None:
+            path = os.environ.get('FAAM_WXRX_CACHE', CACHE_DIR)
+        if max_size is None:
+            max_size = float(os.environ.get('FAAM_WXRX_CACHE_SIZE', CACHE_SIZE))
+        self.Path = path
+        # bytes
+        self.Max_size = int(max_size * 2**20)
+
+    def load_columns(self, key, names):
+        """Returns the columns of the entry as dictionary of read-only
+        memory mapped arrays, or None if there is no entry for the key.
+
+        """
+        path = os.path.join(self.Path, key)
+        if not os.path.isdir(path):
+            return None
+        try:
+            columns = {}
+            for name in names:
+                filename = os.path.join(path, name + '.npy')
+                try:
+                    columns[name] = np.load(filename, mmap_mode='r')
+                except ValueError:
+                    # empty arrays can not be memory mapped
+                    columns[name] = np.load(filename)
+            # the modification time of the entry marks its last use
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return columns
+
+    def open_columns(self, key):
+        """Returns a ColumnWriter for a new entry, to which the columns can
+        be added in parts.
+
+        """
+        return ColumnWriter(self, key)
+
+    def store_columns(self, key, columns):
+        """Adds the dictionary of arrays to the cache (see ColumnWriter)."""
+        entry = self.open_columns(key)
+        entry.append(columns)
+        entry.commit()
+
+    def evict(self, keep=None):
+        """Deletes the least recently used entries until the cache is not
+        larger than its size limit. The entry keep is never deleted.
+
+        """
+        entries = []
+        for key in os.listdir(self.Path):
+            path = os.path.join(self.Path, key)
+            if key != keep and os.path.isdir(path) and not key.endswith('.tmp'):
+                entries.append((os.path.getmtime(path), _get_size_(path), path))
+        total = sum([e[1] for e in entries])
+        if keep and os.path.isdir(os.path.join(self.Path, keep)):
+            total += _get_size_(os.path.join(self.Path, keep))
+        for mtime, size, path in sorted(entries):
+            if total <= self.Max_size:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+
+class ColumnWriter(object):
+    """New entry of a ColumnCache that is filled in parts: every call of
+    append adds rows to the end of the columns and commit adds the entry to
+    the cache.
+
+    The entry is written to a temporary directory first and renamed when
+    it is complete, so that an interrupted run or a second process never
+    leaves a half written entry behind. Nothing is stored if the cache
+    directory can not be written.
+
+    """
+
+    def __init__(self, cache, key):
+        self.Cache = cache
+        self.Key = key
+        self.Tmp_path = '%s.%i.tmp' % (os.path.join(cache.Path, key), os.getpid())
+        # name: [file, dtype, shape of a row, number of rows]
+        self.Columns = {}
+        self.Failed = False
+        try:
+            if not os.path.isdir(cache.Path):
+                os.makedirs(cache.Path)
+            os.mkdir(self.Tmp_path)
+        except (IOError, OSError):
+            self.Failed = True
+
+    def append(self, columns):
+        """Adds the rows of the dictionary of arrays to the columns."""
+        if self.Failed:
+            return
+        try:
+            for name in columns:
+                values = np.ascontiguousarray(columns[name])
+                if name not in self.Columns:
+                    f = open(os.path.join(self.Tmp_path, name + '.npy'), 'wb')
+                    f.write(_get_npy_header_(values.dtype, values.shape[1:], 0))
+                    self.Columns[name] = [f, values.dtype, values.shape[1:], 0]
+                column = self.Columns[name]
+                values.tofile(column[0])
+                column[3] += len(values)
+        except (IOError, OSError):
+            self.abort()
+
+    def commit(self):
+        """Writes the final number of rows into the headers of the columns
+        and adds the entry to the cache.
+
+        """
+        if self.Failed:
+            return
+        try:
+            for f, dtype, shape, rows in self.Columns.values():
+                f.seek(0)
+                f.write(_get_npy_header_(dtype, shape, rows))
+                f.close()
+            os.rename(self.Tmp_path, os.path.join(self.Cache.Path, self.Key))
+        except (IOError, OSError):
+            # e.g. the entry has just been written by another process
+            self.abort()
+            return
+        self.Cache.evict(keep=self.Key)
+
+    def abort(self):
+        """Deletes the unfinished entry."""
+        for column in self.Columns.values():
+            column[0].close()
+        shutil.rmtree(self.Tmp_path, ignore_errors=True)
+        self.Failed = True
+
+
+class RecordCache(ColumnCache):
+    """Decoded records of the tmp-files; every entry holds the record
+    positions (sIndexList) and one column for every field of the records.
+
+    """
+
+    def get_key(self, filename, byte_start, sIndexList):
+        """Returns the key for the records at the bit offsets sIndexList in
+        the data of the tmp-file, which start at byte byte_start.
+
+        """
+        sha1 = hashlib.sha1()
+        sha1.update(get_file_hash(filename).encode('ascii'))
+        sha1.update(('%i:%i:' % (DECODER_VERSION, byte_start)).encode('ascii'))
+        sha1.update(np.ascontiguousarray(sIndexList, dtype=np.int64).tobytes())
+        return sha1.hexdigest()
+
+    def load(self, key):
+        """Returns the cached record positions and records as tuple
+        (sIndexList, records), with records being a dictionary of read-only
+        memory mapped columns, or None if there is no entry for the key.
+
+        """
+        columns = self.load_columns(key, ('sIndexList',) + _REC.dtype.names)
+        if columns is None:
+            return None
+        return columns.pop('sIndexList'), columns
+
+    def open(self, key):
+        """Returns a RecordWriter for a new entry, to which the records of a
+        tmp-file can be added block by block.
+
+        """
+        return RecordWriter(self, key)
+
+    def store(self, key, sIndexList, records):
+        """Adds the record positions and the decoded records to the cache."""
+        entry = self.open(key)
+        entry.append_records(sIndexList, records)
+        entry.commit()
+
+
+class RecordWriter(ColumnWriter):
+    """New entry of a RecordCache (see ColumnWriter)."""
+
+    def append_records(self, sIndexList, records):
+        """Adds the record positions and the decoded records."""
+        columns = dict([(name, records[name]) for name in _REC.dtype.names])
+        columns['sIndexList'] = np.asarray(sIndexList, dtype=np.int64)
+        self.append(columns)
+
+
+class NavCache(ColumnCache):
+    """GIN navigation at the record times; every entry holds one column for
+    every variable in nav.NAV_VARIABLES.
+
+    """
+
+    def get_key(self, core_file, time_hash):
+        """Returns the key for the navigation from the core file at the
+        record times with the sha1 hex digest time_hash.
+
+        """
+        sha1 = hashlib.sha1()
+        sha1.update(get_file_hash(core_file).encode('ascii'))
+        sha1.update(('nav:%i:%s' % (NAV_VERSION, time_hash)).encode('ascii'))
+        return sha1.hexdigest()
+
+    def load(self, key):
+        """Returns the cached navigation as dictionary of read-only memory
+        mapped columns, or None if there is no entry for the key.
+
+        """
+        return self.load_columns(key, [p[0] for p in NAV_VARIABLES])
+
+    def store(self, key, nav):
+        """Adds the navigation (dictionary of columns) to the cache."""
+        self.store_columns(key, nav)
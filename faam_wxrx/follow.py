@@ -0,0 +1,196 @@
+#!/usr/bin/python
+
+"""
+Follows the weather radar tmp-files while CoPilot is still writing them and
+appends the new records to the weather radar netCDF as soon as they can be
+timestamped.
+
+Records can only be timestamped once the filesizeLogger has logged a file
+size beyond them. On every poll the new lines of the log are read and only
+the complete records between the last decoded record and the last logged
+file size are decoded. The record chain is continued exactly where it
+stopped before. As soon as the log moves on to a new tmp-file, the
+previous one is complete and its remaining records are appended first, so
+the records are the same and in the same order as from a post flight run.
+
+The core data can be merged when following is stopped with --core-file.
+The post flight processing does not overwrite the followed netCDF; it has
+to be run with another revision number (-r) or after moving the followed
+netCDF away.
+
+"""
+
+import datetime
+import os
+import sys
+import time
+import numpy as np
+
+from .Arinc708 import Arinc708
+from .Reader import find_records
+from .Writer import Writer, Setup, RecordBlock, STORAGE_PROFILES
+from .utils import FilesizeLog, add_timestamp
+from .processing import _get_log_file_, get_netcdf_filename
+
+# minimum number of new bits before a tmp-file is decoded again; the last
+# 2000 bits of the decoded data are always left for the next poll
+_MIN_NEW_BITS = 2000 + 8 * 1744
+
+
+class Follower(object):
+    """Keeps track of the position in the log and the tmp-files and appends
+    the new records of every poll to the netCDF.
+
+    If the netCDF exists already, e.g. after a restart, the tmp-files are
+    decoded from the start again, but only records that are later than the
+    last record in the netCDF are written.
+
+    callback(time, records) is called with the time (seconds since
+    midnight) and the records that have been written in every poll, e.g.
+    to show them in the quicklook.
+
+    """
+
+    def __init__(self, ROOT_PATH, log_file, ncfile, storage_profile='default', callback=None):
+        self.Root_path = ROOT_PATH
+        self.Callback = callback
+        self.Log = FilesizeLog(log_file, final=False)
+        if not os.path.exists(ncfile):
+            _s = Setup(ncfile, storage_profile=storage_profile)
+            _s.close()
+        self.Writer = Writer(ncfile)
+        self.Last_time = -np.inf
+        if self.Writer.n > 0:
+            self.Last_time = np.max(self.Writer.ds.variables['time'][:])
+        # bit offset of the next record in every tmp-file
+        self.Offsets = {}
+        # tmp-files of which all records have been appended
+        self.Finished = set()
+
+    def poll(self, final=False):
+        """Reads the new log entries and appends the new records of all
+        logged tmp-files. Returns the number of records that were written.
+
+        """
+        self.Log.update(final=final)
+        n = 0
+        # CoPilot starts a new file after a restart; all files before the
+        # last one in the log are complete and are finished before the
+        # records of the next file are appended
+        file_names = self.Log.get_file_names()
+        for i, file_name in enumerate(file_names):
+            if file_name in self.Finished:
+                continue
+            complete = final or i < len(file_names) - 1
+            n += self.__follow_file__(file_name, complete)
+            if complete:
+                self.Finished.add(file_name)
+        return n
+
+    def __follow_file__(self, file_name, final=False):
+        filename = os.path.join(self.Root_path, file_name)
+        if not os.path.exists(filename):
+            return 0
+        seconds, file_size = self.Log.get(file_name)
+        offset = self.Offsets.get(file_name, 0)
+        if final:
+            # the whole file is decoded as in the post flight processing;
+            # records without a timestamp are dropped by the Writer
+            byte_end = os.stat(filename).st_size
+        else:
+            # only the data up to the last logged file size can be timestamped
+            byte_end = int(min(np.max(file_size), os.stat(filename).st_size))
+            if byte_end * 8 - offset < _MIN_NEW_BITS:
+                return 0
+        byte_start = offset // 8
+        # an empty file can not be memory mapped
+        if byte_end <= byte_start:
+            return 0
+        buffer = np.memmap(filename, dtype=np.uint8, mode='r')[byte_start:byte_end]
+        sIndexList, errors = find_records(buffer, len(buffer) * 8, start=offset % 8)
+        if len(sIndexList) == 0:
+            return 0
+        # the next poll continues after the last record
+        self.Offsets[file_name] = byte_start * 8 + int(sIndexList[-1]) + 1600
+        if not final:
+            # after a sync loss the chain can continue at a label close to
+            # the end of the data; such a record is not complete yet, so the
+            # next poll starts at it
+            incomplete = np.where(sIndexList + 1600 > len(buffer) * 8)[0]
+            if len(incomplete):
+                self.Offsets[file_name] = byte_start * 8 + int(sIndexList[incomplete[0]])
+                sIndexList = sIndexList[:incomplete[0]]
+                if len(sIndexList) == 0:
+                    return 0
+        records = Arinc708().parse_many(buffer, sIndexList)
+        # only keep the valid ARINC708 buswords
+        ix = np.where(records['label'] == '550')[0]
+        wxrx_data = RecordBlock(filename, sIndexList[ix] + byte_start * 8, records[ix])
+        add_timestamp(wxrx_data, self.Log)
+        wxrx_data.Timestamp[wxrx_data.Timestamp * 86400. <= self.Last_time] = -9999
+        n = self.Writer.n
+        self.Writer.append(wxrx_data)
+        if self.Callback:
+            time_stamp = wxrx_data.Timestamp * 86400.
+            good_index = np.where(time_stamp > 0)[0]
+            self.Callback(time_stamp[good_index], wxrx_data.Records[good_index])
+        return self.Writer.n - n
+
+    def close(self, core_file=None):
+        """Appends the remaining records, merges the core data if a core
+        file is given and closes the netCDF.
+
+        """
+        self.poll(final=True)
+        if core_file:
+            self.Writer.merge_core_file(core_file)
+        self.Writer.close()
+
+
+def follow(ROOT_PATH, fid, rev, interval=10., storage_profile='default', core_file=None):
+    """Polls the log and the tmp-files every interval seconds until it is
+    stopped with Ctrl-C.
+
+    """
+    WXRX_LOG_FILE = _get_log_file_(ROOT_PATH, fid)
+    BASE_TIME = FilesizeLog(WXRX_LOG_FILE).Base_time
+    WXRX_NETCDF_FILENAME = os.path.join(ROOT_PATH, get_netcdf_filename(BASE_TIME, rev, fid))
+
+    sys.stdout.write('Following ... %s\n' % (WXRX_LOG_FILE))
+    sys.stdout.write('Writing data to ... %s\n' % (WXRX_NETCDF_FILENAME))
+    follower = Follower(ROOT_PATH, WXRX_LOG_FILE, WXRX_NETCDF_FILENAME, storage_profile=storage_profile)
+    try:
+        while True:
+            n = follower.poll()
+            if n:
+                sys.stdout.write('%s  %i new records\n' % (datetime.datetime.now().strftime('%H:%M:%S'), n))
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        sys.stdout.write('Stopped following ...\n')
+    follower.close(core_file)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('data_path', action="store", type=str,
+                        help='directory that contains the raw/tmp weather radar data files and the log file')
+    parser.add_argument('fid', action="store", type=str,
+                        help='flight number (e.g. b655)')
+    parser.add_argument('-r, --revison', dest='revision', action="store",
+                        type=int, default=0,
+                        help='revision number for output netcdf file [default: 0]')
+    parser.add_argument('-i', '--interval', dest='interval', action="store",
+                        type=float, default=10.,
+                        help='seconds between two polls [default: 10]')
+    parser.add_argument('--storage-profile', dest='storage_profile', action="store",
+                        type=str, default='default', choices=sorted(STORAGE_PROFILES.keys()),
+                        help='chunking and compression of the netcdf variables [default: default]')
+    parser.add_argument('--core-file', dest='core_file', action="store",
+                        type=str, default=None,
+                        help='core netCDF file, that is merged when following is stopped')
+    args = parser.parse_args()
+
+    follow(args.data_path, args.fid, args.revision, interval=args.interval,
+           storage_profile=args.storage_profile, core_file=args.core_file)
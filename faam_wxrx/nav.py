@@ -0,0 +1,103 @@
+'''
+Navigation data from the aircraft GIN in the FAAM core netCDF at the time
+of the weather radar records.
+
+The core file holds the GIN variables at 32 Hz as (Time, sps32) arrays,
+where the sample k of row i belongs to Time[i] + k/32. Only the part of the
+core file that covers the radar records is read and all variables are
+interpolated linearly in a single pass. The heading is interpolated via
+its sine and cosine, so that it does not swing around the compass when it
+passes north. Radar records in gaps of the core data or outside of it get
+NaN instead of extrapolated values.
+
+'''
+
+import netCDF4
+import numpy as np
+
+from faam_wxrx.profiling import hot_path
+
+# pairs of (weather radar variable, core variable)
+NAV_VARIABLES = [('hdg_gin',  'HDG_GIN'),
+                 ('lon_gin',  'LON_GIN'),
+                 ('lat_gin',  'LAT_GIN'),
+                 ('alt_gin',  'ALT_GIN'),
+                 ('ptch_gin', 'PTCH_GIN')]
+
+# variables that are angles in degree
+CIRCULAR_VARIABLES = ['hdg_gin']
+
+# longest gap in the core data (seconds) that is still interpolated
+MAX_GAP = 1.0
+
+# version of the interpolation; has to be increased whenever the result
+# changes, so that the navigation from the cache (see cache.py) is not used
+# anymore
+NAV_VERSION = 1
+
+
+@hot_path('read_core_nav')
+def read_core_nav(core_file, t_start, t_end, time_units=None):
+    """Returns the GIN data of the core file between t_start and t_end
+    (seconds) at their full sample rate as tuple (time, values); values has
+    one column for every variable in NAV_VARIABLES. Fill values of the core
+    data are returned as NaN.
+
+    If time_units (e.g. the units of the weather radar time) is given, the
+    core time is converted to them. Otherwise both times are expected to
+    count from the same midnight.
+
+    """
+    ds = netCDF4.Dataset(core_file, 'r')
+    try:
+        time = np.asarray(ds.variables['Time'][:], dtype=float).ravel()
+        if time_units:
+            time += netCDF4.date2num(netCDF4.num2date(0, ds.variables['Time'].units), time_units)
+        # one extra second on both sides for the interpolation
+        i0 = max(np.searchsorted(time, t_start, side='right') - 2, 0)
+        i1 = min(np.searchsorted(time, t_end, side='left') + 2, len(time))
+        columns = []
+        for name, core_name in NAV_VARIABLES:
+            data = np.ma.filled(np.ma.asarray(ds.variables[core_name][i0:i1], dtype=float), np.nan)
+            columns.append(data.reshape(i1 - i0, -1))
+    finally:
+        ds.close()
+    sps = columns[0].shape[1]
+    if any([c.shape[1] != sps for c in columns]):
+        raise ValueError('GIN variables with different sample rates in %s' % core_file)
+    time = (time[i0:i1, np.newaxis] + np.arange(sps) / float(sps)).ravel()
+    values = np.column_stack([c.ravel() for c in columns])
+    return time, values
+
+
+@hot_path('interp_nav')
+def interp_nav(core_time, core_values, time, max_gap=MAX_GAP):
+    """Interpolates the GIN data (see read_core_nav) linearly to the radar
+    time and returns an array with one column for every variable in
+    NAV_VARIABLES. The result is NaN for times that are outside the core
+    data or in gaps longer than max_gap seconds.
+
+    """
+    time = np.asarray(time, dtype=float)
+    circular = [i for i, p in enumerate(NAV_VARIABLES) if p[0] in CIRCULAR_VARIABLES]
+    angles = np.deg2rad(core_values[:, circular])
+    values = np.column_stack((core_values, np.sin(angles), np.cos(angles)))
+
+    n = len(core_time)
+    result = np.zeros((len(time), len(NAV_VARIABLES))) + np.nan
+    if n == 0:
+        return result
+    # core_time[ix0] <= time <= core_time[ix1]
+    ix1 = np.minimum(np.searchsorted(core_time, time, side='left'), n - 1)
+    ix0 = np.where(core_time[ix1] == time, ix1, np.maximum(ix1 - 1, 0))
+    t0, t1 = core_time[ix0], core_time[ix1]
+    valid = (t0 <= time) & (time <= t1) & (t1 - t0 <= max_gap)
+    weight = np.where(t1 > t0, (time - t0) / np.where(t1 > t0, t1 - t0, 1.), 0.)[:, np.newaxis]
+    interp = values[ix0] * (1. - weight) + values[ix1] * weight
+    interp[~valid] = np.nan
+
+    k = len(NAV_VARIABLES)
+    result[:] = interp[:, :k]
+    for j, i in enumerate(circular):
+        result[:, i] = np.mod(np.rad2deg(np.arctan2(interp[:, k + j], interp[:, k + len(circular) + j])), 360.)
+    return result
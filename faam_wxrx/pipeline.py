@@ -0,0 +1,285 @@
+"""
+Processing of the weather radar tmp-files as a pipeline of concurrent
+stages:
+
+  read -> decode -> timestamp -> write
+
+read       opens a tmp-file, finds the record positions (see Reader.parse)
+           and cuts them into blocks. The records are taken from the cache
+           (see cache.py) if possible.
+decode     decodes the blocks in a pool of worker processes (see
+           Arinc708.parse_file).
+timestamp  keeps the valid ARINC708 buswords and adds their timestamps
+           (see utils.add_timestamp).
+write      appends the blocks to the netCDF from a single thread.
+
+Every stage reports its throughput to a RunStats instance (see
+progress.py).
+
+The stages are connected by bounded queues. A stage that is ahead of the
+next one blocks as soon as the queue is full, so only a few blocks are held
+in memory at any time and the run time approaches the time of the slowest
+stage instead of the sum of all stages. The blocks stay in order, so the
+netCDF is the same as from a serial run.
+
+"""
+
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import numpy as np
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from .Arinc708 import parse_file
+from .Reader import Reader
+from .Writer import RecordBlock
+from .progress import RunStats
+from .utils import add_timestamp
+
+# number of records that are decoded and written together
+BLOCK_SIZE = 2**14
+# maximum number of blocks that wait between two stages
+QUEUE_SIZE = 4
+
+# marks the end of the data in a queue
+_DONE = None
+
+
+def _decode_(args):
+    """Decodes a block (see Arinc708.parse_file) and returns the records
+    and the time it took.
+
+    """
+    t = time.time()
+    records = parse_file(*args)
+    return records, time.time() - t
+
+
+class Block(RecordBlock):
+    """Consecutive records of a single tmp-file; every stage fills in a bit
+    more until the block can be passed on to Writer.append.
+
+    """
+
+    def __init__(self, filename, sIndexList, byte_range, last=False):
+        RecordBlock.__init__(self, filename, sIndexList)
+        self.byte_range = byte_range
+        # share of the tmp-file data in the block
+        self.NBytes = 0
+        # the last block of the file
+        self.Last = last
+        # the records were taken from the cache
+        self.Cached = False
+        # result of the decoder pool
+        self.Result = None
+        # key of the cache entry that the records of the file are stored in
+        self.Key = None
+
+
+class Pipeline(object):
+    """Reads, decodes, timestamps and writes the tmp-files in concurrent
+    stages (see module documentation).
+
+    files are the paths of the tmp-files in log order, log is the
+    FilesizeLog and writer the Writer of the netCDF. With workers > 1 the
+    blocks are decoded in that many processes and the record positions of
+    files without an index are searched with the same processes. The
+    statistics of the run are collected in stats (see progress.RunStats);
+    its progress line is started by run and stopped by the caller.
+
+    """
+
+    def __init__(self, files, log, writer, workers=1, cache=None,
+                 block_size=BLOCK_SIZE, queue_size=QUEUE_SIZE, stats=None):
+        self.Files = files
+        self.Log = log
+        self.Writer = writer
+        self.Workers = workers
+        self.Cache = cache
+        self.Block_size = block_size
+        self.Queue_size = queue_size
+        self.Pool = None
+        self.Abort = threading.Event()
+        self.Errors = []
+        # cache entry (see cache.RecordWriter) of the file whose records
+        # are being decoded
+        self.Stored = None
+        self.Stats = stats if stats is not None else RunStats()
+        if not self.Stats.Total_bytes:
+            self.Stats.Total_bytes = sum([os.path.getsize(f) for f in files])
+
+    def run(self):
+        """Runs all stages and returns when the last block is written. The
+        first error of any stage stops the pipeline and is raised again.
+
+        """
+        # the pool is started before the threads and the progress line, so
+        # that no thread is copied into the worker processes
+        if self.Workers > 1:
+            self.Pool = multiprocessing.Pool(self.Workers)
+        self.Stats.start_progress()
+        decode_queue = queue.Queue(self.Queue_size)
+        # enough decoded blocks are kept in flight to keep all workers busy
+        timestamp_queue = queue.Queue(self.Queue_size + self.Workers)
+        write_queue = queue.Queue(self.Queue_size)
+        stages = [(self.__read__, None, decode_queue),
+                  (self.__decode__, decode_queue, timestamp_queue),
+                  (self.__timestamp__, timestamp_queue, write_queue),
+                  (self.__write__, write_queue, None)]
+        threads = []
+        for stage, source, target in stages:
+            # the name shows up in the profile (see profiling.py)
+            thread = threading.Thread(target=self.__run_stage__, args=(stage, source, target),
+                                      name='pipeline-%s' % stage.__name__.strip('_'))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        try:
+            for thread in threads:
+                # join with a timeout, so that Ctrl-C is not blocked
+                while thread.is_alive():
+                    thread.join(0.5)
+        except KeyboardInterrupt:
+            self.Abort.set()
+            raise
+        finally:
+            if self.Stored is not None:
+                # the entry of an unfinished file is not kept
+                self.Stored.abort()
+                self.Stored = None
+            if self.Pool:
+                if self.Abort.is_set():
+                    self.Pool.terminate()
+                else:
+                    self.Pool.close()
+                self.Pool.join()
+                self.Pool = None
+        if self.Errors:
+            raise self.Errors[0]
+
+    def __run_stage__(self, stage, source, target):
+        try:
+            if source is None:
+                items = stage()
+            else:
+                items = (stage(item) for item in self.__get_items__(source))
+            for item in items:
+                if target is not None:
+                    self.__put__(target, item)
+            if target is not None:
+                self.__put__(target, _DONE)
+        except Exception as e:
+            self.Errors.append(e)
+            self.Abort.set()
+
+    def __get_items__(self, source):
+        while not self.Abort.is_set():
+            try:
+                item = source.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is _DONE:
+                return
+            yield item
+
+    def __put__(self, target, item):
+        # a full queue blocks the stage, unless another stage has failed
+        while not self.Abort.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def __read__(self):
+        for filename in self.Files:
+            if self.Abort.is_set():
+                return
+            sys.stdout.write('Reading ... %s\n' % (os.path.basename(filename)))
+            self.Stats.Current_file = filename
+            t = time.time()
+            wxrx_data = Reader(filename, use_mmap=True)
+            wxrx_data.parse(workers=self.Workers, pool=self.Pool)
+            sIndexList = np.asarray(wxrx_data.sIndexList, dtype=np.int64)
+            key, cached = None, None
+            if self.Cache:
+                key = self.Cache.get_key(filename, wxrx_data.byte_range[0], sIndexList)
+                cached = self.Cache.load(key)
+                if cached:
+                    sIndexList = cached[0]
+            nbytes = wxrx_data.byte_range[1] - wxrx_data.byte_range[0]
+            self.Stats.add('read', len(wxrx_data.sIndexList), nbytes, time.time() - t)
+            self.Stats.count(filename, bytes=nbytes, label_errors=len(wxrx_data.Errors),
+                             cached=int(bool(cached)))
+            if cached:
+                # the cache only holds the complete ARINC708 buswords
+                self.Stats.count(filename, incomplete=len(wxrx_data.sIndexList) - len(sIndexList))
+            sys.stdout.write(str(wxrx_data))
+            # every file gives at least one block, so that it is listed in
+            # the netCDF even without records
+            starts = range(0, max(len(sIndexList), 1), self.Block_size)
+            for i in starts:
+                block = Block(filename, sIndexList[i:i+self.Block_size], wxrx_data.byte_range,
+                              last=(i == starts[-1]))
+                # the shares of all blocks add up to the size of the data
+                m = max(len(sIndexList), 1)
+                block.NBytes = nbytes * min(i + self.Block_size, m) // m - nbytes * i // m
+                if cached:
+                    block.Records = dict([(name, cached[1][name][i:i+self.Block_size])
+                                          for name in cached[1]])
+                    block.Cached = True
+                else:
+                    block.Key = key
+                yield block
+
+    def __decode__(self, block):
+        if block.Records is None:
+            args = (block.Filename, block.sIndexList, block.byte_range)
+            if self.Pool:
+                block.Result = self.Pool.apply_async(_decode_, (args,))
+            else:
+                block.Records, seconds = _decode_(args)
+                self.Stats.add('decode', len(block.Records), block.NBytes, seconds)
+        return block
+
+    def __timestamp__(self, block):
+        if block.Result is not None:
+            (block.Records, seconds), block.Result = block.Result.get(), None
+            self.Stats.add('decode', len(block.Records), block.NBytes, seconds)
+        t = time.time()
+        if not block.Cached:
+            # only keep the valid ARINC708 buswords; the record chain only
+            # starts records at labels, so the others run over the end of
+            # the file (see Validator.validate_file)
+            n = len(block.Records)
+            ix = np.where(block.Records['label'] == '550')[0]
+            block.sIndexList, block.Records = block.sIndexList[ix], block.Records[ix]
+            self.Stats.count(block.Filename, incomplete=n - len(ix))
+        if block.Key is not None:
+            self.__store__(block)
+        add_timestamp(block, self.Log)
+        self.Stats.add('timestamp', len(block.sIndexList), block.NBytes, time.time() - t)
+        return block
+
+    def __store__(self, block):
+        # the cache entry holds all records of the file; they are written
+        # block by block and the entry is complete with the last block
+        if self.Stored is None:
+            self.Stored = self.Cache.open(block.Key)
+        self.Stored.append_records(block.sIndexList, block.Records)
+        if block.Last:
+            self.Stored.commit()
+            self.Stored = None
+
+    def __write__(self, block):
+        t, n = time.time(), self.Writer.n
+        self.Writer.append(block)
+        self.Stats.add('write', self.Writer.n - n, block.NBytes, time.time() - t)
+        # records without a timestamp are not written
+        self.Stats.count(block.Filename, records=self.Writer.n - n)
@@ -10,15 +10,16 @@ import sys
 import datetime
 import os
 import re
-import numpy as np
 
-from Arinc708 import Arinc708
-
-from Reader import Reader
-from Writer import Writer, Setup
-from utils import get_wxrx_tmp_filelist, add_timestamp
+from . import __version__
+from .Arinc708 import DECODER_VERSION
+from .Writer import Writer, Setup, STORAGE_PROFILES
+from .cache import RecordCache, NavCache
+from .pipeline import Pipeline
+from .profiling import Profile, MODES, get_mode
+from .progress import RunStats
+from .utils import get_wxrx_tmp_filelist, FilesizeLog
 from .wxrx_plot_overview import Overview
-from .utils import get_base_time
 
 TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
 
@@ -34,13 +35,20 @@ def _get_log_file_(ROOT_PATH, fid):
     return WXRX_LOG_FILE
 
 
-def process(ROOT_PATH, CORE_FILE, fid, rev):
+def get_netcdf_filename(base_time, rev, fid):
+    return 'weather-radar_faam_%s_r%s_%s.nc' % (datetime.datetime.strftime(base_time, '%Y%m%d'), str(rev), str.lower(fid))
+
+
+def process(ROOT_PATH, CORE_FILE, fid, rev, storage_profile='default', workers=1, use_cache=True,
+            report=None, progress=None, profile=None):
 
     WXRX_LOG_FILE = _get_log_file_(ROOT_PATH, fid)
+    # the log is parsed once and shared by all steps below
+    WXRX_LOG = FilesizeLog(WXRX_LOG_FILE)
 
     #set BASE_TIME from the 2nd line (logging start) in the WXRX_LOG_FILE
-    BASE_TIME = get_base_time(WXRX_LOG_FILE)
-    WXRX_NETCDF_FILENAME = 'weather-radar_faam_%s_r%s_%s.nc' % (datetime.datetime.strftime(BASE_TIME, '%Y%m%d'), str(rev), str.lower(fid))
+    BASE_TIME = WXRX_LOG.Base_time
+    WXRX_NETCDF_FILENAME = get_netcdf_filename(BASE_TIME, rev, fid)
 
     if os.path.exists(os.path.join(ROOT_PATH, WXRX_NETCDF_FILENAME)):
         sys.stdout.write('weather radar netCDF\n')
@@ -50,67 +58,76 @@ def process(ROOT_PATH, CORE_FILE, fid, rev):
         sys.exit(2)
 
     # get unique valid wxrx-tmp-filelist from log file
-    wxrx_file_list = get_wxrx_tmp_filelist(WXRX_LOG_FILE)
-    # Calculate total size of tmp-wxrx-data
-    MAX_SIZE = np.max([os.stat(os.path.join(ROOT_PATH, wxrx_file)).st_size for wxrx_file in wxrx_file_list])
-    MAXIMUM_NUMBER_OF_RECORDS = (MAX_SIZE*8/1744) + 1
-    wxrx_data_list = []
-
-    _RECS = np.zeros(MAXIMUM_NUMBER_OF_RECORDS, dtype = [('label',             np.str_, 4),
-                                                         ('control_accept',    np.byte),
-                                                         ('slave',             np.byte),
-                                                         ('mode_annunciation', np.byte),
-                                                         ('faults',            np.byte),
-                                                         ('stabilization',     np.byte),
-                                                         ('operating_mode',    np.byte),
-                                                         ('tilt',              np.float),
-                                                         ('gain',              np.float),
-                                                         ('range',             np.int16),
-                                                         ('data_accept',       np.byte),
-                                                         ('scan_angle',        np.float),
-                                                         ('reflectivity',      np.byte, (512,))])
-
-    A708 = Arinc708()
-
-    for wxrx_file in wxrx_file_list:
-        sys.stdout.write('Reading ... %s\n' % (wxrx_file))
-        # TODO: adding progressbar to see where we are including ETA
-        wxrx_data = Reader(os.path.join(ROOT_PATH, wxrx_file))
-        wxrx_data.parse()
-        sys.stdout.write(wxrx_data)
-        ix = []
-        for i in range(len(wxrx_data.Buswords)):
-            try:
-                _RECS[i] = A708.parse(wxrx_data.Buswords[i])
-                ix.append(i)
-            except:
-                pass
-
-        wxrx_data.sIndexList = list(np.array(wxrx_data.sIndexList)[ix])
-
-        add_timestamp(wxrx_data, WXRX_LOG_FILE)
-        wxrx_data.Records = _RECS[ix]
-        wxrx_data_list.append(wxrx_data)
-        # Delete to save memory
-        del(wxrx_data)
-
-
-    # TODO
-    _s = Setup(os.path.join(ROOT_PATH, WXRX_NETCDF_FILENAME))
+    wxrx_file_list = get_wxrx_tmp_filelist(WXRX_LOG)
+
     sys.stdout.write('Creating empty netCDF ...\n')
+    _s = Setup(os.path.join(ROOT_PATH, WXRX_NETCDF_FILENAME), storage_profile=storage_profile)
+    _s.close()
 
     sys.stdout.write('Writing data to ... %s\n' % (os.path.join(ROOT_PATH, WXRX_NETCDF_FILENAME)))
-    wxrx_nc_writer = Writer(os.path.join(ROOT_PATH, WXRX_NETCDF_FILENAME), wxrx_data_list)
-    wxrx_nc_writer.write()
-    sys.stdout.write('Merging faam_core data ... %s\n' % (CORE_FILE))
-    # TODO
-    wxrx_nc_writer.merge_core_file(CORE_FILE)
-    wxrx_nc_writer.close()
-
-    # create overview figure
-    Overview(os.path.join(ROOT_PATH, WXRX_NETCDF_FILENAME),
-             os.path.join(ROOT_PATH,
-                          '%s_%s_wxrx_overview.png' % (fid, datetime.datetime.strftime(BASE_TIME, '%Y%m%d'))))
+    wxrx_nc_writer = Writer(os.path.join(ROOT_PATH, WXRX_NETCDF_FILENAME))
+
+    # decoded records are reused from earlier runs (see cache.py)
+    cache = RecordCache() if use_cache else None
+
+    # The tmp-files are read, decoded, timestamped and written in
+    # concurrent stages (see pipeline.py). The records are written in
+    # blocks as soon as they are ready, so that only a few blocks have to be
+    # kept in memory.
+    if workers > 1:
+        sys.stdout.write('Decoding with %i workers ...\n' % (workers))
+
+    # throughput of every stage (see progress.py); the progress line is
+    # only shown on a terminal by default and is started by the pipeline
+    # once its worker processes exist
+    if progress is None:
+        progress = sys.stderr.isatty()
+    stats = RunStats(progress=progress)
+    stats.Info.update({'flight': fid,
+                       'revision': rev,
+                       'netcdf': WXRX_NETCDF_FILENAME,
+                       'storage_profile': storage_profile,
+                       'workers': workers,
+                       'version': __version__,
+                       'decoder_version': DECODER_VERSION})
+    # profiling of the hot paths (see profiling.py) is only switched on
+    # with profile or the environment variable FAAM_WXRX_PROFILE
+    profile_mode = get_mode(profile)
+    profiler = Profile(profile_mode) if profile_mode else None
+    if profiler:
+        profiler.start()
+    try:
+        pipeline = Pipeline([os.path.join(ROOT_PATH, wxrx_file) for wxrx_file in wxrx_file_list],
+                            WXRX_LOG, wxrx_nc_writer, workers=workers, cache=cache, stats=stats)
+        pipeline.run()
+
+        sys.stdout.write('Merging faam_core data ... %s\n' % (CORE_FILE))
+        # TODO
+        n = wxrx_nc_writer.n
+        with stats.measure('merge', records=n):
+            wxrx_nc_writer.merge_core_file(CORE_FILE, cache=NavCache() if use_cache else None)
+        # the sweep and time index are written when the file is closed
+        with stats.measure('write'):
+            wxrx_nc_writer.close()
+
+        # create overview figure
+        with stats.measure('overview', records=n):
+            Overview(os.path.join(ROOT_PATH, WXRX_NETCDF_FILENAME),
+                     os.path.join(ROOT_PATH,
+                                  '%s_%s_wxrx_overview.png' % (fid, datetime.datetime.strftime(BASE_TIME, '%Y%m%d'))))
+    finally:
+        if profiler:
+            profiler.stop()
+        stats.stop_progress()
+    sys.stdout.write(str(stats))
+    if profiler:
+        prefix = os.path.join(ROOT_PATH, '%s_%s_wxrx_profile_%s' % (fid, datetime.datetime.strftime(BASE_TIME, '%Y%m%d'),
+                                                                    datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S')))
+        for filename in profiler.dump(prefix):
+            sys.stdout.write('Profile written to ... %s\n' % (filename))
+    if report:
+        stats.write_report(report)
+        sys.stdout.write('Run report written to ... %s\n' % (report))
 
 
 if __name__ == '__main__':
@@ -123,7 +140,27 @@ if __name__ == '__main__':
     parser.add_argument('-r, --revison', dest='revision', action="store",
                         type=int, default=0,
                         help='revision number for output netcdf file [default: 0]')
+    parser.add_argument('--storage-profile', dest='storage_profile', action="store",
+                        type=str, default='default', choices=sorted(STORAGE_PROFILES.keys()),
+                        help='chunking and compression of the netcdf variables [default: default]')
+    parser.add_argument('-w', '--workers', dest='workers', action="store",
+                        type=int, default=1,
+                        help='number of processes that decode the tmp-files [default: 1]')
+    parser.add_argument('--no-cache', dest='use_cache', action="store_false",
+                        help='do not use or fill the cache of decoded records and merged navigation')
+    parser.add_argument('--report', dest='report', action="store",
+                        type=str, default=None,
+                        help='JSON file for the run report with the throughput of every stage')
+    parser.add_argument('--no-progress', dest='progress', action="store_const",
+                        const=False, default=None,
+                        help='do not show the progress line [default: shown on a terminal]')
+    parser.add_argument('--profile', dest='profile', action="store", nargs='?',
+                        type=str, default=None, const='timers', choices=MODES,
+                        help='profile the hot paths with timers or cProfile [default: $FAAM_WXRX_PROFILE or off]')
     args = parser.parse_args()
 
     fid = re.findall('[b,B,c,C]\d{3}', os.path.basename(args.faam_core_netcdf))[0]
-    process(args.data_path, args.faam_core_netcdf, fid, args.revision)
+    process(args.data_path, args.faam_core_netcdf, fid, args.revision,
+            storage_profile=args.storage_profile, workers=args.workers,
+            use_cache=args.use_cache, report=args.report, progress=args.progress,
+            profile=args.profile)
@@ -0,0 +1,247 @@
+"""
+Opt-in profiling of the hot paths of the processing.
+
+Functions on the hot paths are marked with the hot_path decorator, which
+only registers them and returns them unchanged. Profiling therefore costs
+nothing while it is switched off. Profile.start replaces every reference to
+a registered function in the faam_wxrx modules and classes with a timed
+wrapper, and Profile.stop puts the original functions back.
+
+There are two modes:
+
+  timers    number of calls, total and self time of every hot path
+  cprofile  the timers plus cProfile of everything that runs inside a hot
+            path, in every thread (e.g. the stages of pipeline.py)
+
+Profiling is switched on with the environment variable FAAM_WXRX_PROFILE
+(set to 'timers' or 'cprofile') or with the --profile option of the
+processing. For every run the following files are written:
+
+  <prefix>.txt        hot paths and cProfile stats, sorted by time
+  <prefix>.collapsed  time (microseconds) per hot path stack, which can be
+                      turned into a flamegraph with flamegraph.pl or
+                      speedscope
+  <prefix>.prof       cProfile data for e.g. snakeviz (cprofile mode only)
+
+Work that is done in worker processes (workers > 1) is not profiled; use a
+single worker to see the decoding.
+
+"""
+
+import collections
+import cProfile
+import functools
+import os
+import pstats
+import sys
+import threading
+import time
+
+PROFILE_ENV = 'FAAM_WXRX_PROFILE'
+MODES = ('timers', 'cprofile')
+
+# registered hot paths as {name: function}
+_HOT_PATHS = collections.OrderedDict()
+
+
+def hot_path(name):
+    """Decorator that registers a function or method as hot path with the
+    given name. The function itself is not changed.
+
+    """
+    def register(func):
+        _HOT_PATHS[name] = func
+        return func
+    return register
+
+
+def get_mode(mode=None):
+    """Returns the profiling mode from mode or, if that is None, from the
+    environment variable FAAM_WXRX_PROFILE; None means no profiling.
+
+    """
+    if mode is None:
+        mode = os.environ.get(PROFILE_ENV, '')
+    mode = mode.strip().lower()
+    if not mode or mode in ('0', 'no', 'off'):
+        return None
+    if mode not in MODES:
+        # e.g. FAAM_WXRX_PROFILE=1
+        return 'timers'
+    return mode
+
+
+def _get_owners_():
+    """Yields the namespaces (module or class dictionaries) of the loaded
+    faam_wxrx modules.
+
+    """
+    for name, module in list(sys.modules.items()):
+        if module is None or not (name == 'faam_wxrx' or name.startswith('faam_wxrx.')):
+            continue
+        yield module
+        for value in list(vars(module).values()):
+            if isinstance(value, type) and value.__module__ == name:
+                yield value
+
+
+class Profile(object):
+    """Named timers (and cProfile) for the registered hot paths."""
+
+    def __init__(self, mode='timers'):
+        self.Mode = mode
+        # {stack: [calls, total seconds, self seconds]}
+        self.Timers = {}
+        self.Lock = threading.Lock()
+        self.Local = threading.local()
+        self.Profiles = []
+        # replaced references as (owner, attribute, original)
+        self.Patched = []
+        self.Start, self.End = None, None
+
+    def start(self):
+        # one wrapper for every hot path, so that all references (e.g. after
+        # "from .utils import add_timestamp") are the same object again
+        wrappers = dict([(id(func), (func, self.__wrap__(name, func)))
+                         for name, func in _HOT_PATHS.items()])
+        for owner in _get_owners_():
+            for attr, value in list(vars(owner).items()):
+                func, wrapper = wrappers.get(id(value), (None, None))
+                if func is not None and func is value:
+                    setattr(owner, attr, wrapper)
+                    self.Patched.append((owner, attr, value))
+        self.Start = time.time()
+
+    def stop(self):
+        for owner, attr, value in reversed(self.Patched):
+            setattr(owner, attr, value)
+        self.Patched = []
+        self.End = time.time()
+
+    def __wrap__(self, name, func):
+        profile = self
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return profile.__run__(name, func, args, kwargs)
+        return wrapper
+
+    def __run__(self, name, func, args, kwargs):
+        stack = getattr(self.Local, 'stack', None)
+        if stack is None:
+            stack = self.Local.stack = [threading.current_thread().name]
+            self.Local.children = [0.]
+        prof = None
+        if self.Mode == 'cprofile' and len(stack) == 1:
+            prof = self.__get_thread_profile__()
+        stack.append(name)
+        self.Local.children.append(0.)
+        t = time.time()
+        try:
+            if prof is not None:
+                try:
+                    prof.enable()
+                except ValueError:
+                    # only one profiler can be active at a time (Python >= 3.12)
+                    prof = None
+            try:
+                return func(*args, **kwargs)
+            finally:
+                if prof is not None:
+                    prof.disable()
+        finally:
+            seconds = time.time() - t
+            key = ';'.join(stack)
+            children = self.Local.children.pop()
+            stack.pop()
+            self.Local.children[-1] += seconds
+            with self.Lock:
+                timer = self.Timers.setdefault(key, [0, 0., 0.])
+                timer[0] += 1
+                timer[1] += seconds
+                timer[2] += seconds - children
+
+    def __get_thread_profile__(self):
+        prof = getattr(self.Local, 'profile', None)
+        if prof is None:
+            prof = self.Local.profile = cProfile.Profile()
+            with self.Lock:
+                self.Profiles.append(prof)
+        return prof
+
+    def get_timers(self):
+        """Returns a list of (name, calls, total seconds, self seconds) of
+        every hot path, sorted by the total time. Recursive and nested
+        calls of the same hot path are only counted once in the total.
+
+        """
+        result = {}
+        with self.Lock:
+            items = list(self.Timers.items())
+        for stack, (calls, total, own) in items:
+            names = stack.split(';')[1:]
+            name = names[-1]
+            timer = result.setdefault(name, [0, 0., 0.])
+            timer[0] += calls
+            if name not in names[:-1]:
+                timer[1] += total
+            timer[2] += own
+        return sorted([(name,) + tuple(t) for name, t in result.items()],
+                      key=lambda t: t[2], reverse=True)
+
+    def get_collapsed(self):
+        """Returns the self time of every hot path stack in the collapsed
+        stack format ('thread;outer;inner microseconds').
+
+        """
+        with self.Lock:
+            items = sorted(self.Timers.items())
+        return ['%s %i' % (stack, round(t[2] * 1e6)) for stack, t in items if t[2] > 0]
+
+    def get_stats(self):
+        """Returns the merged cProfile stats of all threads or None."""
+        profiles = [p for p in self.Profiles if p.getstats()]
+        if not profiles:
+            return None
+        stats = pstats.Stats(profiles[0])
+        for p in profiles[1:]:
+            stats.add(p)
+        return stats
+
+    def __str__(self):
+        lines = ['%-28s %10s %12s %12s %12s' % ('hot path', 'calls', 'total (s)', 'self (s)', 'mean (ms)')]
+        for name, calls, total, own in self.get_timers():
+            lines.append('%-28s %10i %12.3f %12.3f %12.3f' % (name, calls, total, own, total / calls * 1000.))
+        if self.Start is not None:
+            lines.append('Profiled: %.2f s' % ((self.End or time.time()) - self.Start))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, prefix, limit=40):
+        """Writes the timers, the collapsed stacks and the cProfile stats to
+        files starting with prefix and returns their names.
+
+        """
+        filenames = []
+        stats = self.get_stats()
+        f = open(prefix + '.txt', 'w')
+        try:
+            f.write(str(self))
+            if stats is not None:
+                for sort in ('cumulative', 'tottime'):
+                    f.write('\n')
+                    stats.stream = f
+                    stats.sort_stats(sort).print_stats(limit)
+        finally:
+            f.close()
+        filenames.append(prefix + '.txt')
+        f = open(prefix + '.collapsed', 'w')
+        try:
+            for line in self.get_collapsed():
+                f.write(line + '\n')
+        finally:
+            f.close()
+        filenames.append(prefix + '.collapsed')
+        if stats is not None:
+            stats.dump_stats(prefix + '.prof')
+            filenames.append(prefix + '.prof')
+        return filenames
@@ -0,0 +1,282 @@
+"""
+Throughput, memory and progress of a processing run.
+
+Every stage of the processing (read, decode, timestamp, write, merge,
+overview) reports the records and bytes it has handled and the time it was
+busy with them. From these the records/s and MB/s of every stage are
+derived, which shows the stage that limits the run. The memory (RSS) of
+the process is sampled whenever a stage reports, the peak memory of the run
+is taken from the operating system at the end, and the time to completion
+is estimated from the share of the tmp-file data that has been written.
+
+During the run a progress line is updated on stderr. At the end all numbers
+can be written to a JSON run report, so that the throughput can be
+compared across flights and releases.
+
+"""
+
+import collections
+import contextlib
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+STAGES = ('read', 'decode', 'timestamp', 'write', 'merge', 'overview')
+
+# stages that are shown in the progress line
+_PROGRESS_STAGES = ('read', 'decode', 'write')
+
+
+def get_rss():
+    """Returns the resident memory of the process in bytes or None if it is
+    not available.
+
+    """
+    try:
+        f = open('/proc/self/statm')
+        try:
+            pages = int(f.read().split()[1])
+        finally:
+            f.close()
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, AttributeError):
+        pass
+    # peak instead of current memory
+    return get_peak_rss()
+
+
+def get_peak_rss(children=False):
+    """Returns the peak resident memory in bytes of the process or, with
+    children, of its largest finished child process, or None if it is not
+    available.
+
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on Mac OS
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _format_seconds_(secs):
+    if secs is None:
+        return '--:--:--'
+    secs = int(round(secs))
+    return '%02i:%02i:%02i' % (secs // 3600, secs // 60 % 60, secs % 60)
+
+
+def _rate_(value, seconds):
+    if seconds <= 0:
+        return None
+    return value / seconds
+
+
+class StageStats(object):
+    """Records, bytes and busy time of one processing stage."""
+
+    def __init__(self, name):
+        self.Name = name
+        self.Records = 0
+        self.Bytes = 0
+        # time the stage was busy; for the decoder pool the sum over all
+        # worker processes
+        self.Seconds = 0.
+        # wall clock time of the first and last report
+        self.Start, self.End = None, None
+        # largest RSS of the process sampled when the stage reported; the
+        # other stages run at the same time, so it is not the memory that
+        # the stage itself needs
+        self.Rss = 0
+
+    def add(self, records=0, nbytes=0, seconds=0.):
+        now = time.time()
+        if self.Start is None:
+            self.Start = now - seconds
+        self.End = now
+        self.Records += records
+        self.Bytes += nbytes
+        self.Seconds += seconds
+        self.Rss = max(self.Rss, get_rss() or 0)
+
+    def get_records_per_second(self):
+        return _rate_(self.Records, self.Seconds)
+
+    def get_mb_per_second(self):
+        # e.g. the merge only counts records
+        if not self.Bytes:
+            return None
+        return _rate_(self.Bytes / 1024.**2, self.Seconds)
+
+    def as_dict(self):
+        return {'records': self.Records,
+                'bytes': self.Bytes,
+                'seconds': self.Seconds,
+                'elapsed': (self.End - self.Start) if self.Start is not None else 0.,
+                'records_per_second': self.get_records_per_second(),
+                'mb_per_second': self.get_mb_per_second(),
+                'rss_mb': self.Rss / 1024.**2}
+
+
+class RunStats(object):
+    """Collects the statistics of all stages and of every tmp-file. It can
+    be updated from several threads.
+
+    total_bytes is the size of all tmp-files and is used for the estimated
+    time to completion. With progress a progress line is written to stream
+    every interval seconds between start_progress and stop_progress.
+
+    """
+
+    def __init__(self, total_bytes=0, progress=False, interval=1., stream=None):
+        self.Total_bytes = total_bytes
+        self.Stages = collections.OrderedDict([(name, StageStats(name)) for name in STAGES])
+        self.Files = collections.OrderedDict()
+        # additional information for the run report, e.g. the flight number
+        self.Info = {}
+        self.Start = time.time()
+        self.Current_file = None
+        self.Lock = threading.Lock()
+        self.Progress = progress
+        self.Interval = interval
+        self.Stream = stream if stream is not None else sys.stderr
+        self.Stop = threading.Event()
+        self.Thread = None
+
+    def add(self, stage, records=0, nbytes=0, seconds=0.):
+        """Adds the records and bytes that a stage has handled in seconds."""
+        with self.Lock:
+            self.Stages[stage].add(records, nbytes, seconds)
+
+    @contextlib.contextmanager
+    def measure(self, stage, records=0, nbytes=0):
+        """Context manager that adds the time of its block to a stage."""
+        t = time.time()
+        yield
+        self.add(stage, records, nbytes, time.time() - t)
+
+    def count(self, filename, **counts):
+        """Adds counts (e.g. records, label_errors) to the statistics of a
+        tmp-file.
+
+        """
+        name = os.path.basename(filename)
+        with self.Lock:
+            stats = self.Files.setdefault(name, collections.OrderedDict())
+            for key in counts:
+                stats[key] = stats.get(key, 0) + counts[key]
+
+    def get_total(self, key):
+        with self.Lock:
+            return sum([f.get(key, 0) for f in self.Files.values()])
+
+    def get_fraction(self):
+        """Returns the fraction of the tmp-file data that has been written."""
+        if not self.Total_bytes:
+            return None
+        return min(self.Stages['write'].Bytes / float(self.Total_bytes), 1.)
+
+    def get_eta(self):
+        """Returns the estimated seconds until all tmp-files are written or
+        None if there is no estimate yet.
+
+        """
+        fraction = self.get_fraction()
+        if not fraction:
+            return None
+        elapsed = time.time() - self.Start
+        return elapsed / fraction - elapsed
+
+    def get_progress_line(self):
+        fraction = self.get_fraction()
+        items = ['%5.1f%%' % (fraction * 100.) if fraction is not None else '  ?  ']
+        if self.Current_file:
+            items.append(os.path.basename(self.Current_file))
+        for name in _PROGRESS_STAGES:
+            rate = self.Stages[name].get_records_per_second()
+            if rate is not None:
+                items.append('%s %.0f rec/s' % (name, rate))
+        rss = get_rss()
+        if rss:
+            items.append('RSS %.0f MB' % (rss / 1024.**2))
+        items.append('ETA %s' % _format_seconds_(self.get_eta()))
+        return '  '.join(items)
+
+    def start_progress(self):
+        """Starts updating the progress line in a background thread."""
+        if not self.Progress or self.Thread is not None:
+            return
+        self.Stop.clear()
+        self.Thread = threading.Thread(target=self.__show_progress__)
+        self.Thread.daemon = True
+        self.Thread.start()
+
+    def stop_progress(self):
+        if self.Thread is None:
+            return
+        self.Stop.set()
+        self.Thread.join()
+        self.Thread = None
+        self.Stream.write('\n')
+
+    def __show_progress__(self):
+        while not self.Stop.wait(self.Interval):
+            # the line is padded, so that a shorter line overwrites a
+            # longer one
+            self.Stream.write('\r%-100s' % self.get_progress_line())
+            self.Stream.flush()
+
+    def get_report(self):
+        """Returns all statistics as dictionary."""
+        stages = collections.OrderedDict([(name, s.as_dict()) for name, s in self.Stages.items()])
+        peak_rss = get_peak_rss()
+        # the peak of the decoder processes is only known once they finished
+        children = get_peak_rss(children=True)
+        report = collections.OrderedDict()
+        report.update(sorted(self.Info.items()))
+        report['started'] = datetime.datetime.utcfromtimestamp(self.Start).strftime('%Y-%m-%d %H:%M:%SUTC')
+        report['elapsed'] = time.time() - self.Start
+        report['total_bytes'] = self.Total_bytes
+        report['records'] = self.Stages['write'].Records
+        report['label_errors'] = self.get_total('label_errors')
+        report['incomplete'] = self.get_total('incomplete')
+        report['peak_rss_mb'] = peak_rss / 1024.**2 if peak_rss is not None else None
+        report['peak_rss_workers_mb'] = children / 1024.**2 if children is not None else None
+        report['stages'] = stages
+        report['files'] = [collections.OrderedDict([('name', name)] + list(f.items()))
+                           for name, f in self.Files.items()]
+        return report
+
+    def write_report(self, filename):
+        """Writes the run report as JSON."""
+        f = open(filename, 'w')
+        try:
+            json.dump(self.get_report(), f, indent=2)
+            f.write('\n')
+        finally:
+            f.close()
+
+    def __str__(self):
+        lines = ['', '#' * 20,
+                 '%-10s %10s %10s %12s %10s %10s' % ('stage', 'records', 'busy (s)', 'records/s', 'MB/s', 'RSS (MB)')]
+        for name, s in self.Stages.items():
+            if s.Start is None:
+                continue
+            rate, mb_rate = s.get_records_per_second(), s.get_mb_per_second()
+            lines.append('%-10s %10i %10.2f %12s %10s %10.0f' %
+                         (name, s.Records, s.Seconds,
+                          '%.0f' % rate if rate is not None else '-',
+                          '%.1f' % mb_rate if mb_rate is not None else '-',
+                          s.Rss / 1024.**2))
+        lines.append('Label errors: %i' % self.get_total('label_errors'))
+        lines.append('Incomplete records: %i' % self.get_total('incomplete'))
+        lines.append('Elapsed: %s' % _format_seconds_(time.time() - self.Start))
+        lines.append('#' * 20)
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,324 @@
+#!/usr/bin/python
+
+"""
+Live quicklook of the weather radar data during the flight.
+
+The tmp-files are followed (see follow.py) and the rays of the last minutes
+are kept in a ring buffer. A render thread draws the latest complete
+antenna sweep and a rolling overview (time vs. bin) of the buffer at a
+fixed cadence. The images are served from memory by a small web server, so
+that the cost of rendering does not depend on the number of viewers:
+
+  http://localhost:8080/              page that shows both images
+  http://localhost:8080/scan.png      latest sweep
+  http://localhost:8080/overview.png  rolling overview
+  http://localhost:8080/status.json   state of the buffer
+
+The netCDF is written as in follow mode, so the data are archived anyway.
+
+"""
+
+import datetime
+import json
+import io
+import os
+import sys
+import threading
+import time
+import numpy as np
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from matplotlib.ticker import FuncFormatter
+
+from .follow import Follower
+from .utils import FilesizeLog, get_sweep_index
+from .processing import _get_log_file_, get_netcdf_filename
+from .wxrx_plot_scan import cmap_wxrx, grid_scan
+
+# the radar sends about 190 rays per second (see Reader.__str__)
+_RAYS_PER_SECOND = 200
+# maximum number of grid cells along the forward distance of the scan image
+_SCAN_GRID_SIZE = 200
+# maximum number of rays in the overview image
+_OVERVIEW_WIDTH = 1200
+
+INDEX_HTML = """<html>
+<head>
+<title>FAAM weather radar quicklook</title>
+<meta http-equiv="refresh" content="%(refresh)i">
+</head>
+<body>
+<img src="scan.png">
+<img src="overview.png">
+<p>%(status)s</p>
+</body>
+</html>
+"""
+
+
+class RayBuffer(object):
+    """Ring buffer that holds the latest rays (time, scan angle, tilt,
+    range and reflectivity). It can be filled from one thread and read
+    from another.
+
+    """
+
+    def __init__(self, capacity):
+        self.Capacity = capacity
+        self.time = np.zeros(capacity, dtype=float)
+        self.scan_angle = np.zeros(capacity, dtype=float)
+        self.tilt = np.zeros(capacity, dtype=float)
+        self.range = np.zeros(capacity, dtype=np.int16)
+        self.reflectivity = np.zeros((capacity, 512), dtype=np.byte)
+        # number of rays that have been added in total
+        self.n = 0
+        self.Lock = threading.Lock()
+
+    def add(self, time, records):
+        """Adds the records with their time (seconds since midnight)."""
+        m = len(time)
+        # only the latest rays fit into the buffer
+        time, records = time[-self.Capacity:], records[-self.Capacity:]
+        with self.Lock:
+            ix = (self.n + m - len(time) + np.arange(len(time))) % self.Capacity
+            self.time[ix] = time
+            for name in ('scan_angle', 'tilt', 'range', 'reflectivity'):
+                getattr(self, name)[ix] = records[name]
+            self.n += m
+
+    def get(self):
+        """Returns a copy of the rays in the buffer as dictionary, oldest
+        ray first.
+
+        """
+        with self.Lock:
+            m = min(self.n, self.Capacity)
+            ix = (self.n - m + np.arange(m)) % self.Capacity
+            result = {}
+            for name in ('time', 'scan_angle', 'tilt', 'range', 'reflectivity'):
+                result[name] = getattr(self, name)[ix]
+        return result
+
+
+def _format_time_(secs, pos=None):
+    return (datetime.datetime(2000, 1, 1) + datetime.timedelta(seconds=float(secs) % 86400)).strftime('%H:%M:%S')
+
+
+def _to_png_(fig):
+    buf = io.BytesIO()
+    FigureCanvasAgg(fig).print_png(buf)
+    return buf.getvalue()
+
+
+def render_scan(rays):
+    """Returns the latest complete sweep of the rays as png image or None if
+    there is none.
+
+    """
+    start, end = get_sweep_index(rays['scan_angle'], rays['time'])
+    # the last sweep is usually still being recorded
+    if len(start) < 2:
+        return None
+    ix = np.arange(start[-2], end[-2])
+    # rays with an unknown range setting can not be placed
+    ix = ix[rays['range'][ix] < 9999]
+    if len(ix) < 2:
+        return None
+    radius = rays['range'][ix].astype(float)
+    resolution = max(0.2, np.max(radius) * 1.85 / _SCAN_GRID_SIZE)
+    plot_data = grid_scan(rays['scan_angle'][ix], rays['tilt'][ix], radius,
+                          rays['reflectivity'][ix], resolution=resolution)
+    fig = Figure(figsize=(6, 4))
+    ax = fig.add_subplot(111, aspect='equal')
+    ax.contourf(plot_data['x'], plot_data['y'], plot_data['refl'],
+                levels=np.arange(9) - 0.5, cmap=cmap_wxrx)
+    ax.set_ylim(0, np.max(plot_data['y']))
+    ax.grid()
+    ax.set_xlabel('left-right distance (km)')
+    ax.set_ylabel('fwd distance (km)')
+    ax.set_title('Sweep: %s' % _format_time_(rays['time'][ix[0]]))
+    return _to_png_(fig)
+
+
+def render_overview(rays):
+    """Returns the reflectivity of all rays (time vs. bin) as png image or
+    None if there are no rays.
+
+    """
+    if len(rays['time']) < 2:
+        return None
+    step = int(np.ceil(len(rays['time']) / float(_OVERVIEW_WIDTH)))
+    fig = Figure(figsize=(8, 4))
+    ax = fig.add_subplot(111)
+    img = ax.imshow(rays['reflectivity'][::step].T, aspect='auto', origin='lower',
+                    interpolation='nearest', cmap=cmap_wxrx, vmin=-0.5, vmax=7.5,
+                    extent=(rays['time'][0], rays['time'][-1], 0, 512))
+    ax.xaxis.set_major_formatter(FuncFormatter(_format_time_))
+    ax.set_xlabel('time (UTC)')
+    ax.set_ylabel('bin data (-)')
+    cbar = fig.colorbar(img)
+    cbar.set_ticks([0, 1, 2, 3, 4, 5, 6, 7])
+    return _to_png_(fig)
+
+
+class Quicklook(object):
+    """Renders the images from the ray buffer every cadence seconds and
+    keeps the latest ones in memory.
+
+    """
+
+    def __init__(self, buffer, cadence=5.):
+        self.Buffer = buffer
+        self.Cadence = cadence
+        self.Images = {}
+        self.Status = {'rays': 0, 'last_ray': None, 'rendered': None}
+        self.Lock = threading.Lock()
+        self.Stop = threading.Event()
+        # number of rays in the buffer at the last rendering
+        self.Rendered = 0
+
+    def render(self):
+        """Renders the images if new rays have arrived."""
+        n = self.Buffer.n
+        if n == self.Rendered:
+            return
+        rays = self.Buffer.get()
+        images = {}
+        for name, render in (('scan.png', render_scan), ('overview.png', render_overview)):
+            png = render(rays)
+            if png:
+                images[name] = png
+        with self.Lock:
+            self.Images.update(images)
+            self.Status['rays'] = n
+            self.Status['last_ray'] = _format_time_(rays['time'][-1]) if len(rays['time']) else None
+            self.Status['rendered'] = datetime.datetime.utcnow().strftime('%H:%M:%S')
+        self.Rendered = n
+
+    def run(self):
+        while not self.Stop.is_set():
+            try:
+                self.render()
+            except Exception as e:
+                # a bad sweep must not stop the quicklook
+                sys.stdout.write('Rendering failed ... %s\n' % (e,))
+            self.Stop.wait(self.Cadence)
+
+    def get_image(self, name):
+        with self.Lock:
+            return self.Images.get(name)
+
+    def get_status(self):
+        with self.Lock:
+            return dict(self.Status)
+
+
+class QuicklookHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        quicklook = self.server.quicklook
+        path = self.path.split('?')[0]
+        if path in ('/', '/index.html'):
+            status = quicklook.get_status()
+            content = INDEX_HTML % {'refresh': max(int(quicklook.Cadence), 1),
+                                    'status': 'Rays: %(rays)s, last ray: %(last_ray)s, rendered: %(rendered)s' % status}
+            self.__send__(content.encode('utf-8'), 'text/html')
+        elif path == '/status.json':
+            self.__send__(json.dumps(quicklook.get_status()).encode('utf-8'), 'application/json')
+        else:
+            png = quicklook.get_image(path.lstrip('/'))
+            if png is None:
+                self.send_error(404)
+                return
+            self.__send__(png, 'image/png')
+
+    def __send__(self, content, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class QuicklookServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, quicklook):
+        HTTPServer.__init__(self, address, QuicklookHandler)
+        self.quicklook = quicklook
+
+
+def serve(ROOT_PATH, fid, rev, host='localhost', port=8080, minutes=10., cadence=5.,
+          interval=10., storage_profile='default'):
+    """Follows the tmp-files and serves the quicklook until it is stopped
+    with Ctrl-C.
+
+    """
+    WXRX_LOG_FILE = _get_log_file_(ROOT_PATH, fid)
+    BASE_TIME = FilesizeLog(WXRX_LOG_FILE).Base_time
+    WXRX_NETCDF_FILENAME = os.path.join(ROOT_PATH, get_netcdf_filename(BASE_TIME, rev, fid))
+
+    buffer = RayBuffer(int(minutes * 60 * _RAYS_PER_SECOND))
+    quicklook = Quicklook(buffer, cadence=cadence)
+    follower = Follower(ROOT_PATH, WXRX_LOG_FILE, WXRX_NETCDF_FILENAME,
+                        storage_profile=storage_profile, callback=buffer.add)
+    server = QuicklookServer((host, port), quicklook)
+    threads = [threading.Thread(target=quicklook.run),
+               threading.Thread(target=server.serve_forever)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    sys.stdout.write('Serving quicklook on ... http://%s:%i/\n' % (host, server.server_address[1]))
+    try:
+        while True:
+            follower.poll()
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        sys.stdout.write('Stopped quicklook ...\n')
+    quicklook.Stop.set()
+    server.shutdown()
+    follower.close()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('data_path', action="store", type=str,
+                        help='directory that contains the raw/tmp weather radar data files and the log file')
+    parser.add_argument('fid', action="store", type=str,
+                        help='flight number (e.g. b655)')
+    parser.add_argument('-r, --revison', dest='revision', action="store",
+                        type=int, default=0,
+                        help='revision number for output netcdf file [default: 0]')
+    parser.add_argument('--host', dest='host', action="store",
+                        type=str, default='localhost',
+                        help='address the web server listens on [default: localhost]')
+    parser.add_argument('-p', '--port', dest='port', action="store",
+                        type=int, default=8080,
+                        help='port of the web server [default: 8080]')
+    parser.add_argument('-m', '--minutes', dest='minutes', action="store",
+                        type=float, default=10.,
+                        help='minutes of data that are kept for the overview [default: 10]')
+    parser.add_argument('-c', '--cadence', dest='cadence', action="store",
+                        type=float, default=5.,
+                        help='seconds between two renderings of the images [default: 5]')
+    parser.add_argument('-i', '--interval', dest='interval', action="store",
+                        type=float, default=10.,
+                        help='seconds between two polls of the tmp-files [default: 10]')
+    args = parser.parse_args()
+
+    serve(args.data_path, args.fid, args.revision, host=args.host, port=args.port,
+          minutes=args.minutes, cadence=args.cadence, interval=args.interval)
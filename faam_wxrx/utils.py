@@ -7,9 +7,12 @@ project.
 import datetime
 import numpy as np
 import os
+import sys
 
 from matplotlib.dates import date2num, num2date
 
+from faam_wxrx.profiling import hot_path
+
 TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
 
 
@@ -22,41 +25,107 @@ def get_base_time(wxrx_log_file):
     return base_time
 
 
+class FilesizeLog(object):
+    """Content of the log file that is created by the filesizeLogger.pyw
+    script.
+
+    The log is parsed once and the entries are grouped by weather radar
+    tmp-file, so that a single instance can be shared by all steps of the
+    processing.
+
+    While the logger is still running, new entries can be read with update.
+    final=False then leaves out the last line of the log, if it has not
+    been completely written yet.
+
+    """
+
+    def __init__(self, log_file, final=True):
+        self.Filename = log_file
+        self.Base_time = get_base_time(log_file)
+        # number of bytes of the log file that have been read
+        self.Position = 0
+        self.timestamp = np.zeros(0, dtype='datetime64[s]')
+        self.file_size = np.zeros(0, dtype=float)
+        self.file_name = np.zeros(0, dtype=str)
+        self.seconds = np.zeros(0, dtype=float)
+        self.Files = {}
+        self.update(final=final)
+
+    def update(self, final=True):
+        """Reads the entries that have been added to the log since the last
+        call and returns their number.
+
+        """
+        ifile = open(self.Filename, 'rb')
+        ifile.seek(self.Position)
+        text = ifile.read().decode('ascii', 'replace')
+        ifile.close()
+        if not final:
+            text = text[:text.rfind('\n') + 1]
+        self.Position += len(text)
+        lines = [line for line in text.splitlines() if line.strip()]
+        if not lines:
+            return 0
+        log = np.loadtxt(lines, dtype=str, delimiter=',', comments='#', ndmin=2).reshape(-1, 3)
+        if len(log) == 0:
+            return 0
+        timestamp = np.array(np.char.strip(log[:, 0]), dtype='datetime64[s]')
+        self.timestamp = np.append(self.timestamp, timestamp)
+        self.file_size = np.append(self.file_size, log[:, 1].astype(float))
+        self.file_name = np.append(self.file_name, np.char.strip(log[:, 2]))
+        # seconds since midnight of the day when logging started
+        base_day = np.datetime64(self.Base_time.strftime('%Y-%m-%d'), 's')
+        self.seconds = (self.timestamp - base_day).astype(float)
+        self.Files = {}
+        for fn in self.get_file_names():
+            self.Files[fn] = np.where(self.file_name == fn)[0]
+        return len(log)
+
+    def get_file_names(self):
+        """Returns the names of all logged files in the order in which they
+        first appear in the log.
+
+        """
+        names, ix = np.unique(self.file_name, return_index=True)
+        return list(names[np.argsort(ix)])
+
+    def get(self, file_name):
+        """Returns the seconds since midnight and the logged file sizes
+        (bytes) for a single weather radar tmp-file.
+
+        """
+        ix = self.Files.get(file_name, np.zeros(0, dtype=int))
+        return (self.seconds[ix], self.file_size[ix])
+
+
 def read_log_file(log_file):
     """Reads in the log file that is created by
     filesizeLogger.pyw script.
 
     """
-    f = open(log_file, 'r')
-    log = f.readlines()
-    f.close()
-    timestamp, file_size, file_name = [], [], []
-    # TODO: this should use np.general read in function
-    for line in log:
-        if not line.startswith('#'):
-            tmp = line.split(',')
-            timestamp.append(date2num(datetime.datetime.strptime(tmp[0], TIME_FORMAT)))
-            file_size.append(float(tmp[1]))
-            file_name.append(str.strip(tmp[2]))
-    return (np.array(timestamp), np.array(file_size), np.array(file_name))
+    log = FilesizeLog(log_file)
+    timestamp = date2num(list(log.timestamp.astype(datetime.datetime)))
+    return (np.array(timestamp), log.file_size, log.file_name)
 
 
 def get_wxrx_tmp_filelist(log_file):
     """Get the set of temporary weather radar files.
 
+    log_file is either the path to the log file or a FilesizeLog instance.
     """
     _SIZE_LIMIT = 2485200   #equals ~60 seconds
-    time_stamp_arr, file_size_arr, file_name_arr = read_log_file(log_file)
+    if not isinstance(log_file, FilesizeLog):
+        log_file = FilesizeLog(log_file)
     # need to keep the order
-    tmp_file_list = []
-    [tmp_file_list.append(fn) for fn in list(file_name_arr) if fn not in tmp_file_list]
+    tmp_file_list = log_file.get_file_names()
+    log_path = os.path.dirname(log_file.Filename)
 
     checked_tmp_file_list = []
     for tmp_file in tmp_file_list:
-        if not os.path.exists(os.path.join(os.path.dirname(log_file), tmp_file)):
+        if not os.path.exists(os.path.join(log_path, tmp_file)):
             sys.stdout.write('Skipping ... %s. File does not exist.\n' % (tmp_file))
             continue
-        elif os.stat(os.path.join(os.path.dirname(log_file), tmp_file)).st_size < _SIZE_LIMIT:
+        elif os.stat(os.path.join(log_path, tmp_file)).st_size < _SIZE_LIMIT:
             sys.stdout.write('Skipping ... %s. File is too small.\n' % (tmp_file))
             continue
         else:
@@ -64,41 +133,147 @@ def get_wxrx_tmp_filelist(log_file):
     return checked_tmp_file_list
 
 
+def time_sync_many(s_size_index, timestamp_array, file_size_array):
+    """Calculates the time for many positions in a single weather radar
+    tmp-file at once. The timestamp and file size arrays must only contain
+    the log entries of that file.
+
+    Every position is interpolated between the last log entry with a
+    smaller file size and the first one with a larger file size (see
+    time_sync). Positions outside the logged range get NaN.
+
+    """
+    s_size_index = np.asarray(s_size_index, dtype=float)
+    result = np.zeros(s_size_index.shape) + np.nan
+    if len(file_size_array) == 0:
+        return result
+    # The log entries are usually sorted by file size already. The running
+    # minimum from the end and maximum from the start keep the search right
+    # if they are not: the last entry smaller than s is the last one whose
+    # running minimum is smaller than s and vice versa.
+    suffix_min = np.minimum.accumulate(file_size_array[::-1])[::-1]
+    prefix_max = np.maximum.accumulate(file_size_array)
+    ix1 = np.searchsorted(suffix_min, s_size_index, side='left') - 1
+    ix2 = np.searchsorted(prefix_max, s_size_index, side='right')
+    valid = (ix1 >= 0) & (ix2 < len(file_size_array))
+    ix1, ix2 = ix1[valid], ix2[valid]
+    ratio = (s_size_index[valid] - file_size_array[ix1]) / (file_size_array[ix2] - file_size_array[ix1])
+    result[valid] = ratio * (timestamp_array[ix2] - timestamp_array[ix1]) + timestamp_array[ix1]
+    return result
+
+
 def time_sync(s_size_index, file_name, timestamp_array, file_size_array, file_name_array):
-    # TODO: needs serious speed improvement
-    # TODO: should use the np.interp method
     # filter the records. Only use those records that agree with the file name.
     # A single log file can log the size of several weather radar tmp-files
     filter_index = np.where(file_name_array == file_name)
-    flt_timestamp_array = timestamp_array[filter_index]
-    flt_file_size_array = file_size_array[filter_index]
-    flt_file_name_array = file_name_array[filter_index]
     # calculate the time using the timestamps before and after the submitted one using interpolation
-    try:
-        ix1 = np.max(np.where(flt_file_size_array < s_size_index))
-        ix2 = np.min(np.where(flt_file_size_array > s_size_index))
-        ratio = (s_size_index - flt_file_size_array[ix1]) / (flt_file_size_array[ix2] - flt_file_size_array[ix1])
-        timestamp = ratio * (flt_timestamp_array[ix2] - flt_timestamp_array[ix1]) + flt_timestamp_array[ix1]
-        return num2date(timestamp)
-    except:
+    timestamp = time_sync_many([s_size_index],
+                               timestamp_array[filter_index],
+                               file_size_array[filter_index])[0]
+    if np.isnan(timestamp):
         return None
+    return num2date(timestamp)
 
 
+@hot_path('add_timestamp')
 def add_timestamp(wxrx_data, log_file):
-    base_time = get_base_time(log_file)
-    wxrx_data.Base_time = base_time
-    wxrx_data.Timestamp = []
-    timestamp_array, file_size_array, file_name_array = read_log_file(log_file)
+    """Adds the Timestamp (days since midnight) for every record position
+    in wxrx_data.sIndexList.
+
+    log_file is either the path to the log file or a FilesizeLog instance.
+    """
+    if not isinstance(log_file, FilesizeLog):
+        log_file = FilesizeLog(log_file)
+    wxrx_data.Base_time = log_file.Base_time
+    seconds, file_size = log_file.get(os.path.basename(wxrx_data.Filename))
     # convert units to Bits
-    file_size_array = file_size_array * 8.
-    fname = os.path.basename(wxrx_data.Filename)
-    # TODO: try to avoid loop
-    for size in wxrx_data.sIndexList:
-        ts = time_sync(size, fname, timestamp_array, file_size_array, file_name_array)
-        if ts != None:
-            wxrx_data.Timestamp.append(date2num(ts) - np.floor(date2num(base_time)))
-        else:
-            wxrx_data.Timestamp.append(-9999)
+    timestamp = time_sync_many(wxrx_data.sIndexList, seconds, file_size * 8.)
+    wxrx_data.Timestamp = timestamp / 86400.
+    wxrx_data.Timestamp[np.isnan(timestamp)] = -9999
+
+
+def add_counts(counts, values):
+    """Adds the number of times every value occurs in values to the
+    dictionary counts (value: count).
+
+    """
+    values, n = np.unique(values, return_counts=True)
+    for value, count in zip(values.tolist(), n.tolist()):
+        counts[value] = counts.get(value, 0) + count
+
+
+def get_sweep_index(scan_angle, time=None, min_length=10, max_gap=1.0):
+    """Finds the antenna sweeps from the direction reversals of the
+    scan_angle and returns the index of the first record of every sweep and
+    the index after its last record.
+
+    The angles are converted to -180 to 180 degrees, so that the sweep is
+    continuous when it passes the aircraft nose. Runs of fewer than
+    min_length records in one direction are treated as noise. If time
+    (seconds) is given, a new sweep is also started after every data gap
+    longer than max_gap.
+
+    """
+    angle = np.mod(np.asarray(scan_angle, dtype=float) + 180., 360.) - 180.
+    n = len(angle)
+    if n < 2:
+        return (np.zeros(min(n, 1), dtype=int), np.zeros(min(n, 1), dtype=int) + n)
+    direction = np.sign(np.diff(angle))
+    # keep the last direction, where the angle does not change
+    ix = np.where(direction != 0, np.arange(len(direction)), 0)
+    direction = direction[np.maximum.accumulate(ix)]
+    run_start = np.append(0, np.where(np.diff(direction) != 0)[0] + 1)
+    run_length = np.diff(np.append(run_start, len(direction)))
+    # short runs get the direction of the run before them
+    ix = np.where((run_length >= min_length) | (np.arange(len(run_start)) == 0),
+                  np.arange(len(run_start)), 0)
+    run_direction = direction[run_start][np.maximum.accumulate(ix)]
+    start = run_start[np.append(True, np.diff(run_direction) != 0)]
+    if time is not None:
+        gaps = np.where(np.diff(np.asarray(time, dtype=float)) > max_gap)[0] + 1
+        start = np.union1d(start, gaps)
+    end = np.append(start[1:], n)
+    return (start, end)
+
+
+def get_time_index(time):
+    """Returns the index of the first record at or after every full second
+    from the first to one past the last second in time (seconds). The last
+    entry is always the number of records.
+
+    Time is expected to increase; records that go back in time are covered
+    by the running maximum.
+
+    """
+    time = np.maximum.accumulate(np.asarray(time, dtype=float))
+    if len(time) == 0:
+        return (0, np.zeros(1, dtype=int))
+    start = int(np.floor(time[0]))
+    seconds = start + np.arange(int(np.floor(time[-1])) - start + 2)
+    return (start, np.searchsorted(time, seconds, side='left'))
+
+
+def get_record_slice(ds, sec_start, sec_end):
+    """Returns the first and last+1 index of the records with
+    sec_start <= time < sec_end from an open weather radar netCDF.
+
+    If the netCDF has a time_index only the few records around the start
+    and end of the window are read, otherwise the full time variable.
+
+    """
+    time = ds.variables['time']
+    lo, hi = 0, len(time)
+    if 'time_index' in ds.variables and len(ds.variables['time_index']) > 0:
+        index = ds.variables['time_index']
+        m = len(index)
+        k0 = int(np.clip(np.floor(sec_start) - index.start_time, 0, m-1))
+        k1 = int(np.clip(np.floor(sec_end) - index.start_time + 1, 0, m-1))
+        lo, hi = int(index[k0]), int(index[k1])
+    t = time[lo:hi]
+    ix = np.where((t >= sec_start) & (t < sec_end))[0]
+    if len(ix) == 0:
+        return (lo, lo)
+    return (lo + int(ix[0]), lo + int(ix[-1]) + 1)
 
 
 def conv_angle_to_bearing(angle):
@@ -33,9 +33,11 @@ import re
 import scipy.ndimage.interpolation
 import sys
 
-from matplotlib.mlab import griddata
 from matplotlib.dates import date2num
 
+from faam_wxrx.profiling import hot_path
+from faam_wxrx.utils import get_record_slice
+
 cmap_wxrx = mpl.colors.ListedColormap(['grey',
                                        'lime',
                                        'yellow',
@@ -47,19 +49,21 @@ cmap_wxrx = mpl.colors.ListedColormap(['grey',
 
 
 
-def get_mpl_time(ds):
+def get_mpl_time(ds, ix_s=None, ix_e=None):
     """Converts the time stamp from a netCDF file into a matplotlib useable format.
+    Only the records from ix_s to ix_e are read, if given.
 
     """
     pattern = '\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}'
     base_time_string = re.findall(pattern, str(ds.variables['time'].units).strip())[0]
     base_time = datetime.datetime.strptime(base_time_string, '%Y-%m-%d %H:%M:%S')
-    result = ds.variables['time'][:]/86400. + date2num(base_time)
+    result = ds.variables['time'][ix_s:ix_e]/86400. + date2num(base_time)
     return result
 
 
 class Overview(object):
 
+    @hot_path('Overview')
     def __init__(self, netcdf_ds, imgfile, sec_start=None, sec_end=None):
         self.sec_start = sec_start
         self.sec_end = sec_end
@@ -78,10 +82,9 @@ class Overview(object):
 
     def __get_data__(self):
         if self.sec_start and self.sec_end:
-            ix_s = np.min(np.where(self.ncds.variables['time'][:] > self.sec_start))
-            ix_e = np.max(np.where(self.ncds.variables['time'][:] < self.sec_end))
-            tmp_img_data = self.ncds.variables['reflectivity'][:][ix_s:ix_e]
-            self.X = get_mpl_time(self.ncds)[ix_s:ix_e]
+            ix_s, ix_e = get_record_slice(self.ncds, self.sec_start, self.sec_end)
+            tmp_img_data = self.ncds.variables['reflectivity'][ix_s:ix_e]
+            self.X = get_mpl_time(self.ncds, ix_s, ix_e)
         else:
             tmp_img_data = self.ncds.variables['reflectivity'][:]
             self.X = get_mpl_time(self.ncds)
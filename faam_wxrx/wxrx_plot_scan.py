@@ -15,7 +15,7 @@ import matplotlib.pyplot as plt
 import scipy.interpolate
 import scipy.stats
 
-from utils import conv_polar_to_cartesian, conv_compass_to_cartesian, rotate_coord, conv_angle_to_bearing
+from faam_wxrx.utils import conv_polar_to_cartesian, conv_compass_to_cartesian, rotate_coord, conv_angle_to_bearing, get_record_slice
 
 cmap_wxrx = mpl.colors.ListedColormap(['grey',
                                        'lime',
@@ -27,6 +27,43 @@ cmap_wxrx = mpl.colors.ListedColormap(['grey',
                                        'white'], name='cmap_wxrx')
 
 
+def grid_scan(scan_angle, tilt, radius, refl, resolution=0.2):
+    """Interpolates the reflectivity of the rays of a sweep onto a regular
+    grid (left-right and forward distance from the aircraft nose) with a
+    spacing of resolution km. radius is the range setting in nm.
+
+    Returns a dictionary with the grid (x_grid, y_grid), its axes (x, y)
+    and the reflectivity (refl), which is -1 outside the scanned area.
+
+    """
+    #convert radius from nm to km
+    radius = radius * 1.85
+    y, x, z = conv_polar_to_cartesian(scan_angle, tilt, radius)
+    #grid_x, grid_y = np.mgrid[np.linspace(np.min(x), np.max(x), n), np.linspace(np.min(y), np.max(y), n)]
+    _x_dim = (-np.max(radius), np.max(radius), resolution)
+    _y_dim = (0, np.max(radius), resolution)
+    grid_x, grid_y = np.mgrid[_x_dim[0]:_x_dim[1]:_x_dim[2],
+                              _y_dim[0]:_y_dim[1]:_y_dim[2]]
+    dist = np.sqrt(grid_x**2 + grid_y**2)
+    result = scipy.interpolate.griddata((x.ravel(), y.ravel()),
+                                        refl.ravel(),
+                                        (grid_x, grid_y),
+                                        method='nearest')
+    ix = dist > np.min(radius)
+    result[ix] = -1
+    ix = np.rad2deg(np.arctan(grid_y/np.abs(grid_x))) < 10.0
+    result[ix] = -1
+    plot_data = {}
+    plot_data['x_grid'] = grid_x
+    plot_data['y_grid'] = grid_y
+    plot_data['x'] = grid_x[:, 0]
+    plot_data['y'] = grid_y[0, :]
+
+    #transpose reflectivity variable
+    plot_data['refl'] = result.T
+    return plot_data
+
+
 class Scan(object):
     """WeatherRadar scan plot.
 
@@ -46,9 +83,28 @@ class Scan(object):
         #self._close_netcdf_()
 
     def _get_index_(self):
+        """Gets the first and last+1 record index of the antenna sweep at
+        the requested time. The sweep index that is stored in the netCDF is
+        used if available.
+
+        """
+        if 'sweep_start' not in self.ncds.variables or \
+           len(self.ncds.dimensions['sweep']) == 0:
+            self._get_index_from_scan_angle_()
+            return
+        sweep_time = self.ncds.variables['sweep_time'][:]
+        k = max(np.searchsorted(sweep_time, self.Time, side='right') - 1, 0)
+        self.ix_lower = int(self.ncds.variables['sweep_start'][k])
+        self.ix_upper = int(self.ncds.variables['sweep_end'][k])
+
+    def _get_index_from_scan_angle_(self):
+        """Finds the sweep from the turn-around of the scan angle for files
+        without the sweep index.
+
+        """
         n = 1000
         secs = self.Time
-        ix_timestamp = np.min(np.where(np.array(self.ncds.variables['time'][:], dtype=int) == secs))
+        ix_timestamp = get_record_slice(self.ncds, secs, secs + 1)[0]
         vals = self.ncds.variables['scan_angle'][ix_timestamp + np.arange(-n, 0)]
         ix = np.where((vals > 79) & (vals < 80) | (vals > 279) & (vals < 280))[0]
         ix_lower = np.max(ix) - n + ix_timestamp
@@ -72,32 +128,8 @@ class Scan(object):
         self.Position['lat'] = np.mean(self.ncds.variables['lat_gin'][self.ix_lower:self.ix_upper])
         self.Position['lon'] = np.mean(self.ncds.variables['lon_gin'][self.ix_lower:self.ix_upper])
         radius = self.ncds.variables['range'][self.ix_lower:self.ix_upper]
-        #convert radius from nm to km
-        radius = radius * 1.85
-        y, x, z = conv_polar_to_cartesian(scan_angle, tilt, radius)
         refl = self.ncds.variables['reflectivity'][self.ix_lower:self.ix_upper]
-        #grid_x, grid_y = np.mgrid[np.linspace(np.min(x), np.max(x), n), np.linspace(np.min(y), np.max(y), n)]
-        _x_dim = (-np.max(radius), np.max(radius), 0.2)
-        _y_dim = (0, np.max(radius), 0.2)
-        grid_x, grid_y = np.mgrid[_x_dim[0]:_x_dim[1]:_x_dim[2],
-                                  _y_dim[0]:_y_dim[1]:_y_dim[2]]
-        dist = np.sqrt(grid_x**2 + grid_y**2)
-        result = scipy.interpolate.griddata((x.ravel(), y.ravel()),
-                                            refl.ravel(),
-                                            (grid_x, grid_y),
-                                            method='nearest')
-        ix = dist > np.min(radius)
-        result[ix] = -1
-        ix = np.rad2deg(np.arctan(grid_y/np.abs(grid_x))) < 10.0
-        result[ix] = -1
-        self.Plot_data = {}
-        self.Plot_data['x_grid'] = grid_x
-        self.Plot_data['y_grid'] = grid_y
-        self.Plot_data['x'] = grid_x[:, 0]
-        self.Plot_data['y'] = grid_y[0, :]
-
-        #transpose reflectivity variable
-        self.Plot_data['refl'] = result.T
+        self.Plot_data = grid_scan(scan_angle, tilt, radius, refl)
 
     def _plot_(self):
         #m.get_cmap('cmap_wxrx')
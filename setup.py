@@ -41,7 +41,8 @@ setup(name = "faam_wxrx",
       # scripts are defined in the aimms.__init__ file
       entry_points={
           'console_scripts': [
-                'faam_wxrx = faam_wxrx:command_line',]
+                'faam_wxrx = faam_wxrx:command_line',
+                'faam_wxrx_validate = faam_wxrx.Validator:main',]
           },
       license='LGPLv3',
       platforms = ['linux', 'windows'],